@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from parser import load_events, parse_events_columnar, extract_tactics
+from metrics import compute_heatmap, compute_windowed_metrics_fused
+from loader import read_open_data_matches
+from utils import save_match_metrics
+from store import save_match_store
+from instrument import enable, match_scope, read_log, summary as stage_summary
+
+def competition_match_ids(competition_id, season_id, data_dir=None):
+    '''Function to list the match ids of a competition season, from local open-data files when data_dir is given.'''
+    if data_dir is not None:
+        matches = read_open_data_matches(competition_id, season_id, data_dir)
+    else:
+        from statsbombpy import sb
+        matches = sb.matches(competition_id=competition_id, season_id=season_id)
+    return sorted(int(match_id) for match_id in matches["match_id"])
+
+def team_ids(df):
+    '''Function to map team names to team ids for save_match_metrics.'''
+    teams = df[["team_name", "team_id"]].dropna().drop_duplicates("team_name")
+    return {name: int(team_id) for name, team_id in zip(teams["team_name"], teams["team_id"])}
+
+def process_match(match_id, output_dir, data_dir=None, cache_dir=None, window_size=15, grid_size=8, output_format="json"):
+    '''Function to run load -> parse -> tactics -> windowed metrics -> save for one match.
+
+    output_format "json" writes the save_match_metrics layout, "store" a single metrics store file.'''
+    with match_scope(match_id):
+        events_df = load_events(match_id, data_dir=data_dir, cache_dir=cache_dir)
+        events_df_final = parse_events_columnar(events_df)
+        tactics_df_final, main_df_final = extract_tactics(events_df_final)
+        windowed_metrics = compute_windowed_metrics_fused(main_df_final, window_size=window_size, grid_size=grid_size)
+        if output_format == "store":
+            heatmaps = compute_heatmap(main_df_final, grid_size=grid_size)
+            save_match_store(windowed_metrics, match_id, team_ids(main_df_final), output_dir, heatmaps=heatmaps)
+        else:
+            save_match_metrics(windowed_metrics, match_id, team_ids(main_df_final), output_dir)
+    return {
+        "events": len(events_df),
+        "windows": sum(len(blocks) for blocks in windowed_metrics.values()),
+    }
+
+def _run_match(match_id, output_dir, options):
+    '''Function to run process_match in a worker and report the outcome instead of raising.'''
+    start = time.perf_counter()
+    try:
+        result = process_match(match_id, output_dir, **options)
+        result["status"] = "ok"
+    except Exception as e:
+        result = {"status": "failed", "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+    result["match_id"] = match_id
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+def run_batch(match_ids, output_dir, workers=None, data_dir=None, cache_dir=None, window_size=15, grid_size=8, skip_existing=False, output_format="json"):
+    '''Function to process many matches across a process pool.
+
+    Each match writes its metrics as soon as it finishes and a status line is appended to
+    output_dir/batch_log.jsonl; a failing match is logged and the batch carries on.'''
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    log_path = output_path / "batch_log.jsonl"
+    options = {"data_dir": data_dir, "cache_dir": cache_dir, "window_size": window_size, "grid_size": grid_size, "output_format": output_format}
+
+    match_ids = list(dict.fromkeys(match_ids))
+    if skip_existing:
+        suffix = ".thm" if output_format == "store" else "_metrics.json"
+        match_ids = [m for m in match_ids if not (output_path / "metrics" / f"{m}{suffix}").exists()]
+    workers = workers or os.cpu_count() or 1
+    total = len(match_ids)
+    summary = {"total": total, "ok": 0, "failed": []}
+    start = time.perf_counter()
+
+    def record(result, done):
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(result) + "\n")
+        if result["status"] == "ok":
+            summary["ok"] += 1
+        else:
+            summary["failed"].append(result["match_id"])
+        elapsed = time.perf_counter() - start
+        print(f"[{done}/{total}] match {result['match_id']} {result['status']} in {result['seconds']:.1f}s "
+              f"({elapsed:.0f}s elapsed, {len(summary['failed'])} failed)", flush=True)
+
+    if workers == 1:
+        for done, match_id in enumerate(match_ids, start=1):
+            record(_run_match(match_id, output_dir, options), done)
+        return summary
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_run_match, match_id, output_dir, options): match_id for match_id in match_ids}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"match_id": futures[future], "status": "failed", "error": f"{type(e).__name__}: {e}", "seconds": 0.0}
+            record(result, done)
+    return summary
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Rebuild match metrics for many matches in parallel.")
+    arg_parser.add_argument("--competition", type=int, help="competition id, used with --season")
+    arg_parser.add_argument("--season", type=int, help="season id, used with --competition")
+    arg_parser.add_argument("--match-ids", type=int, nargs="*", default=[])
+    arg_parser.add_argument("--output-dir", default="output")
+    arg_parser.add_argument("--workers", type=int, default=None, help="process count (default: all cores)")
+    arg_parser.add_argument("--data-dir", default=os.environ.get("STATSBOMB_DATA_DIR"))
+    arg_parser.add_argument("--cache-dir", default=os.environ.get("EVENT_CACHE_DIR"))
+    arg_parser.add_argument("--window-size", type=int, default=15)
+    arg_parser.add_argument("--grid-size", type=int, default=8)
+    arg_parser.add_argument("--skip-existing", action="store_true")
+    arg_parser.add_argument("--output-format", choices=["json", "store"], default="json")
+    arg_parser.add_argument("--instrument", default=None, help="append per-stage timing and memory records to this JSON lines file")
+    arg_parser.add_argument("--profile-stage", nargs="*", default=[], help="also run these stages under cProfile (with --instrument)")
+    args = arg_parser.parse_args()
+    if args.instrument:
+        enable(args.instrument, profile_stages=args.profile_stage, profile_dir=Path(args.output_dir) / "profiles")
+
+    match_ids = list(args.match_ids)
+    if args.competition is not None and args.season is not None:
+        match_ids += competition_match_ids(args.competition, args.season, args.data_dir)
+    if not match_ids:
+        arg_parser.error("give --match-ids or --competition and --season")
+
+    summary = run_batch(match_ids, args.output_dir, args.workers, args.data_dir, args.cache_dir,
+                        args.window_size, args.grid_size, args.skip_existing, args.output_format)
+    print(f"Finished {summary['ok']}/{summary['total']} matches, {len(summary['failed'])} failed: {summary['failed']}")
+    if args.instrument:
+        print(stage_summary(read_log(args.instrument)))
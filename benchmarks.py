@@ -0,0 +1,488 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from parser import parse_events, parse_events_columnar, extract_tactics, COORDINATE_COLUMNS
+from metrics import compute_heatmap, compute_heatmap_tensor, compute_windowed_metrics, compute_windowed_metrics_fused
+from scipy.sparse import vstack
+from possession import possession_chains
+from timecube import TimeCube
+from live import LiveAccumulator
+from store import write_metrics_store, MetricsStore
+from utils import save_match_metrics, stack_flux_windows, summarize_flux_matrix, summarize_flux_windows
+from batch import team_ids
+
+EVENT_TYPES = ["Pass", "Ball Receipt*", "Carry", "Pressure", "Shot", "Goal Keeper", "Duel", "Clearance"]
+EVENT_WEIGHTS = [0.3, 0.27, 0.23, 0.1, 0.01, 0.01, 0.04, 0.04]
+END_LOCATION_TYPES = {
+    "pass_end_location": "Pass",
+    "carry_end_location": "Carry",
+    "goalkeeper_end_location": "Goal Keeper",
+    "shot_end_location": "Shot",
+}
+
+def _random_locations(rng, n):
+    '''Function to draw n StatsBomb pitch locations as [x, y] lists.'''
+    xs = np.round(rng.uniform(0, 120, n), 1)
+    ys = np.round(rng.uniform(0, 80, n), 1)
+    return [[x, y] for x, y in zip(xs.tolist(), ys.tolist())]
+
+TEAMS = [("England", 768), ("Netherlands", 941)]
+SQUAD_SIZE = 18
+FORMATION_POSITIONS = {
+    433: [(1, "Goalkeeper"), (2, "Right Back"), (3, "Right Center Back"), (5, "Left Center Back"), (6, "Left Back"),
+          (10, "Center Defensive Midfield"), (13, "Right Center Midfield"), (15, "Left Center Midfield"),
+          (17, "Right Wing"), (23, "Center Forward"), (21, "Left Wing")],
+    442: [(1, "Goalkeeper"), (2, "Right Back"), (3, "Right Center Back"), (5, "Left Center Back"), (6, "Left Back"),
+          (12, "Right Midfield"), (13, "Right Center Midfield"), (15, "Left Center Midfield"),
+          (16, "Left Midfield"), (22, "Right Center Forward"), (24, "Left Center Forward")],
+}
+
+def _tactics(formation, squad, slots):
+    '''Function to build a Starting XI or Tactical Shift tactics dict for the squad members in slots.'''
+    return {
+        "formation": formation,
+        "lineup": [
+            {"player": {"id": squad[k][0], "name": squad[k][1]},
+             "position": {"id": position_id, "name": position_name},
+             "jersey_number": k + 1}
+            for k, (position_id, position_name) in zip(slots, FORMATION_POSITIONS[formation])
+        ],
+    }
+
+def synthetic_events(n_events=3500, seed=0):
+    '''Function to generate a StatsBomb-shaped match with nested location lists, lineups and substitutions.
+
+    Besides n_events open-play events grouped into possessions, each team gets a Starting XI with a
+    tactics dict, three substitutions and sometimes a Tactical Shift. Every open-play event is credited
+    to whoever holds the drawn lineup slot at that time, so lineups, positions and events agree.'''
+    rng = np.random.default_rng(seed)
+    team_names = np.array([name for name, _ in TEAMS], dtype=object)
+    team_id_values = np.array([team_id for _, team_id in TEAMS])
+    seconds = np.sort(rng.integers(0, 95 * 60, n_events))
+    possession = np.searchsorted(np.cumsum(rng.geometric(1 / 6, size=n_events)), np.arange(n_events), side="right")
+    n_possessions = possession[-1] + 1 if n_events else 0
+    possession_team = (rng.integers(0, 2) + np.arange(n_possessions) + (rng.random(n_possessions) < 0.2)) % 2
+    team = possession_team[possession]
+    team = np.where(rng.random(n_events) < 0.15, 1 - team, team)
+    slot = rng.integers(0, 11, n_events)
+    squad_index = slot.copy()
+    formation_of = np.full(n_events, 433)
+    types = rng.choice(EVENT_TYPES, size=n_events, p=EVENT_WEIGHTS)
+
+    squads, tactical_rows = [], []
+    for t, (team_name, team_id) in enumerate(TEAMS):
+        squad = [(team_id * 100 + k, f"{team_name} Player {k + 1}") for k in range(SQUAD_SIZE)]
+        squads.append(squad)
+        slots, formation, bench = list(range(11)), 433, iter(range(11, SQUAD_SIZE))
+        team_row = {"team": team_name, "team_id": team_id}
+        tactical_rows.append({**team_row, "type": "Starting XI", "time": 0, "tactics": _tactics(formation, squad, slots)})
+
+        changes = [("Substitution", int(time)) for time in rng.integers(46 * 60, 88 * 60, 3)]
+        if rng.random() < 0.5:
+            changes.append(("Tactical Shift", int(rng.integers(55 * 60, 80 * 60))))
+        for event_type, time in sorted(changes, key=lambda change: change[1]):
+            after = (team == t) & (seconds >= time)
+            if event_type == "Substitution":
+                k, incoming = int(rng.integers(1, 11)), next(bench)
+                position_id, position_name = FORMATION_POSITIONS[formation][k]
+                tactical_rows.append({**team_row, "type": event_type, "time": time,
+                                      "player": squad[slots[k]][1], "player_id": squad[slots[k]][0],
+                                      "position": position_name, "position_id": position_id,
+                                      "substitution_replacement": squad[incoming][1], "substitution_replacement_id": squad[incoming][0]})
+                slots[k] = incoming
+                squad_index[after & (slot == k)] = incoming
+            else:
+                formation = 442
+                tactical_rows.append({**team_row, "type": event_type, "time": time, "tactics": _tactics(formation, squad, slots)})
+                formation_of[after] = formation
+
+    names = np.array([[name for _, name in squad] for squad in squads], dtype=object)
+    ids = np.array([[player_id for player_id, _ in squad] for squad in squads])
+    positions = {formation: np.array(places, dtype=object) for formation, places in FORMATION_POSITIONS.items()}
+    position = np.where((formation_of == 433)[:, None], positions[433][slot], positions[442][slot])
+
+    df = pd.DataFrame({
+        "time": seconds,
+        "possession": possession + 2,
+        "possession_team": team_names[possession_team[possession]],
+        "type": types,
+        "team": team_names[team],
+        "team_id": team_id_values[team],
+        "player": names[team, squad_index],
+        "player_id": ids[team, squad_index].astype(float),
+        "position": position[:, 1],
+        "position_id": position[:, 0].astype(float),
+        "location": _random_locations(rng, n_events),
+    })
+    for column, event_type in END_LOCATION_TYPES.items():
+        locations = pd.Series(np.nan, index=df.index, dtype=object)
+        rows = np.flatnonzero(types == event_type)
+        values = _random_locations(rng, len(rows))
+        if column == "shot_end_location":
+            values = [v + [round(float(z), 1)] if z < 3 else v for v, z in zip(values, rng.uniform(0, 6, len(rows)))]
+        locations.iloc[rows] = pd.Series(values, dtype=object).to_numpy()
+        df[column] = locations
+
+    tactical = pd.DataFrame(tactical_rows)
+    next_event = np.searchsorted(seconds, tactical["time"].to_numpy()).clip(max=max(n_events - 1, 0))
+    tactical["possession"] = possession[next_event] + 2 if n_events else 1
+    tactical["possession_team"] = tactical["team"]
+    df = pd.concat([tactical, df], ignore_index=True).sort_values("time", kind="stable").reset_index(drop=True)
+    df.insert(0, "index", np.arange(1, len(df) + 1))
+    df.insert(1, "period", np.where(df["time"] < 45 * 60, 1, 2))
+    df.insert(2, "minute", df["time"] // 60)
+    df.insert(3, "second", df["time"] % 60)
+    return df.drop(columns="time")
+
+def synthetic_season(n_matches=38, events_per_match=3500, seed=0):
+    '''Function to generate a season of synthetic matches stacked into one frame.'''
+    matches = []
+    for i in range(n_matches):
+        match_df = synthetic_events(events_per_match, seed=seed + i)
+        match_df["match_id"] = 3900000 + i
+        matches.append(match_df)
+    return pd.concat(matches, ignore_index=True)
+
+def _time(func, *args, repeat=1):
+    '''Function to return the best wall time of func over repeat runs, and its last result.'''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_parse_events(n_matches=38, events_per_match=3500, seed=0, repeat=1):
+    '''Function to compare parse_events with parse_events_columnar and check the unpacked columns match.'''
+    events_df = synthetic_season(n_matches, events_per_match, seed)
+    legacy_time, legacy_df = _time(parse_events, events_df, repeat=repeat)
+    columnar_time, columnar_df = _time(parse_events_columnar, events_df, repeat=repeat)
+
+    unpacked = [name for names in COORDINATE_COLUMNS.values() for name in names]
+    unpacked += ["player_name", "team_name", "type.name"]
+    pd.testing.assert_frame_equal(legacy_df[unpacked], columnar_df[unpacked])
+
+    print(f"parse_events ({len(events_df)} events): {legacy_time:.3f}s")
+    print(f"parse_events_columnar ({len(events_df)} events): {columnar_time:.3f}s")
+    print(f"speedup: {legacy_time / columnar_time:.1f}x, unpacked columns identical")
+    return {"events": len(events_df), "parse_events": legacy_time, "parse_events_columnar": columnar_time}
+
+def _assert_windowed_equal(expected, actual):
+    '''Function to check two windowed_pass_fluxes structures hold the same windows, fluxes and zone counts.'''
+    assert list(expected) == list(actual)
+    for team_name, blocks in expected.items():
+        assert list(blocks) == list(actual[team_name])
+        for block_index, metrics_data in blocks.items():
+            other = actual[team_name][block_index]
+            assert metrics_data["window"] == other["window"]
+            assert (metrics_data["flux"] != other["flux"]).nnz == 0
+            pd.testing.assert_frame_equal(metrics_data["channel"], other["channel"])
+            pd.testing.assert_frame_equal(metrics_data["third"], other["third"])
+            pd.testing.assert_frame_equal(metrics_data["zone"], other["zone"])
+
+def bench_windowed_metrics(n_matches=38, events_per_match=3500, seed=0, window_sizes=(1, 5, 15), grid_size=8, repeat=1):
+    '''Function to compare compute_windowed_metrics with compute_windowed_metrics_fused match by match.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    matches = [match_df for _, match_df in events_df.groupby("match_id")]
+    results = {}
+    for window_size in window_sizes:
+        run = lambda func: [func(match_df, window_size, grid_size) for match_df in matches]
+        legacy_time, legacy = _time(run, compute_windowed_metrics, repeat=repeat)
+        fused_time, fused = _time(run, compute_windowed_metrics_fused, repeat=repeat)
+        for expected, actual in zip(legacy, fused):
+            _assert_windowed_equal(expected, actual)
+
+        print(f"compute_windowed_metrics (window={window_size}, {n_matches} matches): {legacy_time:.3f}s")
+        print(f"compute_windowed_metrics_fused (window={window_size}, {n_matches} matches): {fused_time:.3f}s")
+        print(f"speedup: {legacy_time / fused_time:.1f}x, outputs identical")
+        results[window_size] = {"compute_windowed_metrics": legacy_time, "compute_windowed_metrics_fused": fused_time}
+    return results
+
+def bench_heatmap_tensor(n_matches=38, events_per_match=3500, seed=0, by=(["match_id", "player_name"], ["team_name", "type.name"]), grid_size=8, repeat=1):
+    '''Function to compare compute_heatmap with compute_heatmap_tensor and check every entity's heatmap matches.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    results = {}
+    for keys in by:
+        legacy_time, heatmaps = _time(compute_heatmap, events_df, keys, grid_size, repeat=repeat)
+        tensor_time, (tensor, entities) = _time(compute_heatmap_tensor, events_df, keys, grid_size, repeat=repeat)
+        assert len(heatmaps) == len(entities)
+        for key, heat in heatmaps.items():
+            assert np.array_equal(heat, tensor[entities.get_loc(key)])
+
+        print(f"compute_heatmap (by={keys}, {len(entities)} entities): {legacy_time:.3f}s")
+        print(f"compute_heatmap_tensor (by={keys}, {len(entities)} entities): {tensor_time:.3f}s")
+        print(f"speedup: {legacy_time / tensor_time:.1f}x, heatmaps identical")
+        results[str(keys)] = {"compute_heatmap": legacy_time, "compute_heatmap_tensor": tensor_time}
+    return results
+
+def bench_possession_chains(n_matches=38, events_per_match=3500, seed=0, grid_size=8, repeat=1):
+    '''Function to compare possession_chains on a whole season with one call per match and check both give the same chains.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    matches = [match_df for _, match_df in events_df.groupby("match_id", sort=True)]
+
+    def per_match():
+        results = [possession_chains(match_df, grid_size) for match_df in matches]
+        chains = pd.concat([chains for chains, _ in results], ignore_index=True)
+        return chains.assign(chain_id=np.arange(len(chains))), vstack([flux for _, flux in results], format="csr")
+
+    per_match_time, (expected_chains, expected_flux) = _time(per_match, repeat=repeat)
+    season_time, (chains, flux) = _time(possession_chains, events_df, grid_size, repeat=repeat)
+    pd.testing.assert_frame_equal(chains, expected_chains)
+    assert flux.shape == expected_flux.shape and (flux != expected_flux).nnz == 0
+
+    print(f"possession_chains (per match, {n_matches} matches): {per_match_time:.3f}s")
+    print(f"possession_chains (season, {len(chains)} chains): {season_time:.3f}s")
+    print("season chains identical to per-match chains")
+    return {"per_match": per_match_time, "season": season_time}
+
+def bench_time_cube(n_matches=38, events_per_match=3500, seed=0, window_size=15, grid_size=8, repeat=1):
+    '''Function to compare TimeCube heatmaps and windowed fluxes with compute_heatmap and compute_windowed_metrics match by match.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    matches = [match_df for _, match_df in events_df.groupby("match_id")]
+    legacy_time, legacy = _time(lambda: [(compute_heatmap(match_df, grid_size=grid_size), compute_windowed_metrics(match_df, window_size, grid_size)) for match_df in matches], repeat=repeat)
+    cube_time, cubes = _time(lambda: [TimeCube.from_events(match_df, grid_size) for match_df in matches], repeat=repeat)
+    for (heatmaps, windowed), cube in zip(legacy, cubes):
+        cube_heatmaps = cube.heatmaps()
+        assert list(heatmaps) == list(cube_heatmaps)
+        for team, heat in heatmaps.items():
+            assert np.array_equal(heat, cube_heatmaps[team])
+        fluxes = cube.windowed_fluxes(window_size)
+        expected = {team: {block_index: metrics_data for block_index, metrics_data in blocks.items() if metrics_data["flux"].nnz}
+                    for team, blocks in windowed.items()}
+        assert list(expected) == list(fluxes)
+        for team, blocks in expected.items():
+            assert list(blocks) == list(fluxes[team])
+            for block_index, metrics_data in blocks.items():
+                assert metrics_data["window"] == fluxes[team][block_index]["window"]
+                assert (metrics_data["flux"] != fluxes[team][block_index]["flux"]).nnz == 0
+
+    print(f"compute_heatmap + compute_windowed_metrics (window={window_size}, {n_matches} matches): {legacy_time:.3f}s")
+    print(f"TimeCube.from_events ({n_matches} matches): {cube_time:.3f}s")
+    print("cube heatmaps and windowed fluxes identical")
+    return {"legacy": legacy_time, "time_cube": cube_time}
+
+def bench_live_accumulator(n_matches=38, events_per_match=3500, seed=0, window_size=15, grid_size=8, batch_size=50, repeat=1):
+    '''Function to feed each match to a LiveAccumulator in batches and check it ends with the batch heatmaps and windowed metrics.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    matches = [match_df for _, match_df in events_df.groupby("match_id")]
+
+    def live():
+        accumulators = []
+        for match_df in matches:
+            accumulator = LiveAccumulator(grid_size, window_size)
+            for start in range(0, len(match_df), batch_size):
+                accumulator.add_events(match_df.iloc[start:start + batch_size])
+            accumulators.append(accumulator)
+        return accumulators
+
+    live_time, accumulators = _time(live, repeat=repeat)
+    for match_df, accumulator in zip(matches, accumulators):
+        _assert_windowed_equal(compute_windowed_metrics(match_df, window_size, grid_size), accumulator.windowed_metrics())
+        heatmaps, live_heatmaps = compute_heatmap(match_df, grid_size=grid_size), accumulator.heatmaps()
+        assert list(heatmaps) == list(live_heatmaps)
+        for team, heat in heatmaps.items():
+            assert np.array_equal(heat, live_heatmaps[team])
+
+    print(f"LiveAccumulator.add_events (batches of {batch_size}, {n_matches} matches): {live_time:.3f}s")
+    print("live heatmaps and windowed metrics identical to the batch ones")
+    return {"live": live_time}
+
+def bench_metrics_store(n_matches=38, events_per_match=3500, seed=0, window_size=15, grid_size=8, repeat=1):
+    '''Function to write a season's windowed metrics to one MetricsStore and check every match reads back unchanged.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    matches = {int(match_id): compute_windowed_metrics(match_df, window_size, grid_size) for match_id, match_df in events_df.groupby("match_id")}
+    with tempfile.TemporaryDirectory() as output_dir:
+        path = os.path.join(output_dir, "season.thm")
+        entries = [{"match_id": match_id, "team_infor": dict(TEAMS), "windowed_metrics": windowed} for match_id, windowed in matches.items()]
+        write_time, _ = _time(write_metrics_store, path, entries, repeat=repeat)
+        store = MetricsStore(path)
+        read_time, stored = _time(lambda: {match_id: store.windowed_metrics(match_id) for match_id in matches}, repeat=repeat)
+        for match_id, windowed in matches.items():
+            _assert_windowed_equal(windowed, stored[match_id])
+            windows, flux = stack_flux_windows(windowed, match_id)
+            stored_windows, stored_flux = store.stacked_flux(match_id)
+            pd.testing.assert_frame_equal(windows, stored_windows, check_dtype=False)
+            assert (flux != stored_flux).nnz == 0
+        del store, stored, stored_flux
+
+    print(f"write_metrics_store ({n_matches} matches): {write_time:.3f}s")
+    print(f"MetricsStore.windowed_metrics ({n_matches} matches): {read_time:.3f}s")
+    print("stored windowed metrics and stacked fluxes identical")
+    return {"write": write_time, "read": read_time}
+
+def bench_flux_summaries(n_matches=38, events_per_match=3500, seed=0, window_size=5, grid_size=8, top_n_lanes=3, repeat=1):
+    '''Function to compare summarize_flux_matrix window by window with summarize_flux_windows on the stacked season.'''
+    events_df = parse_events_columnar(synthetic_season(n_matches, events_per_match, seed))
+    matches = {int(match_id): compute_windowed_metrics(match_df, window_size, grid_size) for match_id, match_df in events_df.groupby("match_id")}
+    stacked = [stack_flux_windows(windowed, match_id) for match_id, windowed in matches.items()]
+    windows = pd.concat([w for w, _ in stacked], ignore_index=True)
+    flux = vstack([f for _, f in stacked], format="csr")
+
+    legacy_time, legacy = _time(lambda: [summarize_flux_matrix(metrics_data["flux"], top_n_lanes) for windowed in matches.values()
+                                         for blocks in windowed.values() for metrics_data in blocks.values()], repeat=repeat)
+    stacked_time, summary = _time(summarize_flux_windows, windows, flux, top_n_lanes, repeat=repeat)
+    lanes = summary.groupby(["match_id", "team_name", "block_index"], sort=False)
+    assert lanes.ngroups == len(legacy)
+    for expected, (_, window_lanes) in zip(legacy, lanes):
+        assert expected["total_passes"] == int(window_lanes["total_passes"].iloc[0])
+        top_lanes = [{"from_cell": int(f), "to_cell": int(t), "count": int(c)}
+                     for f, t, c in zip(window_lanes["from_cell"], window_lanes["to_cell"], window_lanes["count"]) if pd.notna(c)]
+        assert expected["top_lanes"] == top_lanes
+
+    print(f"summarize_flux_matrix ({len(legacy)} windows): {legacy_time:.3f}s")
+    print(f"summarize_flux_windows ({len(legacy)} windows): {stacked_time:.3f}s")
+    print(f"speedup: {legacy_time / stacked_time:.1f}x, summaries identical")
+    return {"summarize_flux_matrix": legacy_time, "summarize_flux_windows": stacked_time}
+
+SUITE_STAGES = ["parse_events", "parse_events_columnar", "extract_tactics", "compute_heatmap",
+                "compute_windowed_metrics", "compute_windowed_metrics_fused", "save_match_metrics"]
+
+SUITE_REPEAT = 5
+
+def _measure(func, repeat=SUITE_REPEAT):
+    '''Function to return the best wall time of func over repeat runs, a noise estimate and its peak traced memory.
+
+    The noise is the gap between the median and the best run; peak memory is taken in one extra run.'''
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    seconds, noise = min(times), float(np.median(times) - min(times))
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, noise, peak
+
+def _suite_stages(events_df, output_dir, window_size=15, grid_size=8):
+    '''Function to build one zero-argument callable per pipeline stage; inputs of later stages are prepared up front.'''
+    parsed_df = parse_events_columnar(events_df)
+    parsed_matches = [match_df for _, match_df in parsed_df.groupby("match_id", sort=True)]
+    main_matches = [extract_tactics(match_df)[1] for match_df in parsed_matches]
+    main_df = pd.concat(main_matches)
+    windowed = [compute_windowed_metrics_fused(match_df, window_size, grid_size) for match_df in main_matches]
+
+    def save_all():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for match_df, windowed_metrics in zip(main_matches, windowed):
+                save_match_metrics(windowed_metrics, int(match_df["match_id"].iloc[0]), team_ids(match_df), output_dir)
+
+    return {
+        "parse_events": lambda: parse_events(events_df),
+        "parse_events_columnar": lambda: parse_events_columnar(events_df),
+        "extract_tactics": lambda: [extract_tactics(match_df) for match_df in parsed_matches],
+        "compute_heatmap": lambda: compute_heatmap(main_df, ["match_id", "team_name"], grid_size),
+        "compute_windowed_metrics": lambda: [compute_windowed_metrics(match_df, window_size, grid_size) for match_df in main_matches],
+        "compute_windowed_metrics_fused": lambda: [compute_windowed_metrics_fused(match_df, window_size, grid_size) for match_df in main_matches],
+        "save_match_metrics": save_all,
+    }
+
+def run_suite(sizes=(1, 38), events_per_match=3500, seed=0, stages=SUITE_STAGES, repeat=SUITE_REPEAT, window_size=15, grid_size=8):
+    '''Function to time every pipeline stage and record its peak memory on synthetic seasons of each size.
+
+    sizes are numbers of matches; 286 matches of 3500 events make a 1M-event season. Returns a
+    JSON-serialisable dict of environment details and, per size, the seconds and peak bytes of each stage.'''
+    results = {}
+    for n_matches in sizes:
+        events_df = synthetic_season(n_matches, events_per_match, seed)
+        with tempfile.TemporaryDirectory() as output_dir:
+            runners = _suite_stages(events_df, output_dir, window_size, grid_size)
+            size_results = {"matches": n_matches, "events": len(events_df), "stages": {}}
+            for stage in stages:
+                seconds, noise, peak = _measure(runners[stage], repeat=repeat)
+                size_results["stages"][stage] = {"seconds": round(seconds, 6), "seconds_noise": round(noise, 6), "peak_bytes": int(peak)}
+                print(f"{len(events_df):>9} events  {stage:<32} {seconds:9.3f}s  {peak / 1024 ** 2:9.1f} MiB", flush=True)
+        results[f"{n_matches}x{events_per_match}"] = size_results
+    return {
+        "created_at": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {"seed": seed, "repeat": repeat, "window_size": window_size, "grid_size": grid_size},
+        "results": results,
+    }
+
+def compare_to_baseline(suite, baseline, threshold=0.25, min_seconds=0.05, min_bytes=1024 ** 2, noise_factor=3):
+    '''Function to list stages that got slower or used more memory than the baseline by more than threshold.
+
+    A slowdown must also exceed min_seconds and noise_factor times the larger seconds_noise of the two
+    runs, so stages whose timings jitter between repeats are not flagged; memory growth must exceed
+    min_bytes. Sizes or stages missing from either run are skipped.'''
+    regressions = []
+    for size, size_results in suite["results"].items():
+        baseline_stages = baseline["results"].get(size, {}).get("stages", {})
+        for stage, current in size_results["stages"].items():
+            previous = baseline_stages.get(stage)
+            if previous is None:
+                continue
+            noise = max(current.get("seconds_noise", 0), previous.get("seconds_noise", 0))
+            for metric, floor in (("seconds", max(min_seconds, noise_factor * noise)), ("peak_bytes", min_bytes)):
+                if current[metric] > previous[metric] * (1 + threshold) and current[metric] - previous[metric] > floor:
+                    regressions.append({
+                        "size": size,
+                        "stage": stage,
+                        "metric": metric,
+                        "baseline": previous[metric],
+                        "current": current[metric],
+                        "ratio": round(current[metric] / previous[metric], 3) if previous[metric] else None,
+                    })
+    return regressions
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark event parsing, heatmaps and windowed metrics on synthetic seasons.")
+    arg_parser.add_argument("--matches", type=int, default=38)
+    arg_parser.add_argument("--events-per-match", type=int, default=3500)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=None, help=f"runs per timing, best kept (default 1, or {SUITE_REPEAT} with --suite)")
+    arg_parser.add_argument("--suite", action="store_true", help="time every pipeline stage per size instead of comparing implementations")
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[1, 38], help="season sizes in matches for --suite (286 is about 1M events)")
+    arg_parser.add_argument("--stages", nargs="+", choices=SUITE_STAGES, default=SUITE_STAGES)
+    arg_parser.add_argument("--save-baseline", default=None, help="write the --suite results to this JSON file")
+    arg_parser.add_argument("--baseline", default=None, help="compare the --suite results with this JSON file")
+    arg_parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown or memory growth reported as a regression")
+    args = arg_parser.parse_args()
+
+    if not args.suite:
+        args.repeat = args.repeat or 1
+        bench_parse_events(args.matches, args.events_per_match, args.seed, args.repeat)
+        bench_windowed_metrics(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        bench_heatmap_tensor(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        bench_possession_chains(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        bench_time_cube(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        bench_live_accumulator(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        bench_metrics_store(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        bench_flux_summaries(args.matches, args.events_per_match, args.seed, repeat=args.repeat)
+        sys.exit(0)
+
+    suite = run_suite(args.sizes, args.events_per_match, args.seed, args.stages, args.repeat or SUITE_REPEAT)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(suite, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(suite, json.load(f), threshold=args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['size']} {r['stage']} {r['metric']}: {r['baseline']} -> {r['current']} ({r['ratio']}x)")
+        print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
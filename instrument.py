@@ -0,0 +1,207 @@
+import contextvars
+import cProfile
+import functools
+import inspect
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+INSTRUMENT_ENV = "PIPELINE_INSTRUMENT"
+PROFILE_ENV = "PIPELINE_PROFILE_STAGES"
+
+_current_match = contextvars.ContextVar("current_match", default=None)
+
+class _State:
+    '''Process-wide instrumentation settings; stage wrappers only read enabled when it is off.'''
+
+    def __init__(self):
+        self.enabled = False
+        self.log_path = None
+        self.memory = True
+        self.profile_stages = set()
+        self.profile_dir = None
+        self.records = []
+        self.frames = []
+        self.profile_count = 0
+        self.started_tracemalloc = False
+
+_state = _State()
+
+def enable(log_path=None, memory=True, profile_stages=(), profile_dir=None):
+    '''Function to switch instrumentation on for this process and the worker processes it starts.
+
+    Records are kept in memory (see records and summary) and appended as JSON lines to log_path
+    when given. memory=True measures each stage's peak allocation with tracemalloc, which slows
+    allocation-heavy stages; profile_stages are also run under cProfile with their stats dumped
+    to profile_dir.'''
+    _state.enabled = True
+    _state.log_path = Path(log_path) if log_path is not None else None
+    _state.memory = memory
+    _state.profile_stages = set(profile_stages)
+    _state.profile_dir = Path(profile_dir or "profiles")
+    if _state.log_path is not None:
+        _state.log_path.parent.mkdir(parents=True, exist_ok=True)
+        os.environ[INSTRUMENT_ENV] = str(_state.log_path)
+        os.environ[PROFILE_ENV] = ",".join(sorted(_state.profile_stages))
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state.started_tracemalloc = True
+
+def disable():
+    '''Function to switch instrumentation off; records collected so far are kept.'''
+    _state.enabled = False
+    os.environ.pop(INSTRUMENT_ENV, None)
+    os.environ.pop(PROFILE_ENV, None)
+    if _state.started_tracemalloc:
+        tracemalloc.stop()
+        _state.started_tracemalloc = False
+
+def records():
+    '''Function to return the records collected in this process.'''
+    return list(_state.records)
+
+def clear():
+    _state.records.clear()
+
+def summary(stage_records=None):
+    '''Function to aggregate records per stage: calls, total and mean wall time, CPU time, peak memory and rows.'''
+    df = pd.DataFrame(_state.records if stage_records is None else stage_records)
+    if df.empty:
+        return df
+    return df.groupby("stage").agg(
+        calls=("stage", "size"),
+        wall_seconds=("wall_seconds", "sum"),
+        mean_wall_seconds=("wall_seconds", "mean"),
+        cpu_seconds=("cpu_seconds", "sum"),
+        peak_bytes=("peak_bytes", "max"),
+        rows_in=("rows_in", "sum"),
+        bytes_written=("bytes_written", "sum"),
+    ).sort_values("wall_seconds", ascending=False)
+
+def read_log(log_path):
+    '''Function to read a JSON lines instrumentation log into a DataFrame.'''
+    with open(log_path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+@contextmanager
+def match_scope(match_id):
+    '''Function to tag every stage record made inside the block with match_id.'''
+    token = _current_match.set(match_id)
+    try:
+        yield
+    finally:
+        _current_match.reset(token)
+
+def _rows(value):
+    '''Function to count the rows of a stage input or output: frames by length, tuples item by item, windowed metrics by window.'''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, tuple):
+        counts = [_rows(v) for v in value]
+        return counts if any(c is not None for c in counts) else None
+    if isinstance(value, dict) and value and all(isinstance(v, dict) for v in value.values()):
+        return sum(len(v) for v in value.values())
+    return None
+
+def _bytes_written():
+    '''Function to read the bytes this process has written so far (Linux only).'''
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+def _emit(record):
+    _state.records.append(record)
+    if _state.log_path is not None:
+        with open(_state.log_path, 'a') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+def _run(name, match_position, func, args, kwargs):
+    '''Function to run one stage call and record its cost.'''
+    match_id = _current_match.get()
+    if match_id is None and match_position is not None:
+        match_id = kwargs.get("match_id", args[match_position] if len(args) > match_position else None)
+    rows_in = _rows(args[0]) if args else None
+
+    tracing = _state.memory and tracemalloc.is_tracing()
+    if tracing:
+        current, peak_before = tracemalloc.get_traced_memory()
+        if _state.frames:
+            _state.frames[-1] = max(_state.frames[-1], peak_before)
+        tracemalloc.reset_peak()
+        _state.frames.append(current)
+    profiler = cProfile.Profile() if name in _state.profile_stages else None
+    written_before = _bytes_written()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        if profiler is not None:
+            result = profiler.runcall(func, *args, **kwargs)
+        else:
+            result = func(*args, **kwargs)
+    finally:
+        wall_seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        written_after = _bytes_written()
+        peak_bytes = None
+        if tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            frame_peak = max(_state.frames.pop(), peak)
+            peak_bytes = frame_peak - current
+            if _state.frames:
+                _state.frames[-1] = max(_state.frames[-1], frame_peak)
+
+    profile_path = None
+    if profiler is not None:
+        _state.profile_dir.mkdir(parents=True, exist_ok=True)
+        _state.profile_count += 1
+        profile_path = _state.profile_dir / f"{name}_{match_id}_{os.getpid()}_{_state.profile_count}.prof"
+        profiler.dump_stats(profile_path)
+
+    _emit({
+        "stage": name,
+        "match_id": match_id,
+        "wall_seconds": round(wall_seconds, 6),
+        "cpu_seconds": round(cpu_seconds, 6),
+        "peak_bytes": peak_bytes,
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else None,
+        "rows_in": rows_in,
+        "rows_out": _rows(result),
+        "bytes_written": written_after - written_before if written_before is not None and written_after is not None else None,
+        "profile_path": str(profile_path) if profile_path is not None else None,
+        "pid": os.getpid(),
+        "timestamp": time.time(),
+    })
+    return result
+
+def stage(name=None):
+    '''Decorator to record a pipeline stage when instrumentation is enabled.
+
+    Disabled, the wrapper costs one attribute check per call. The match id comes from match_scope
+    or, failing that, from the function's own match_id argument.'''
+    def decorate(func):
+        stage_name = name or func.__name__
+        parameters = list(inspect.signature(func).parameters)
+        match_position = parameters.index("match_id") if "match_id" in parameters else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return func(*args, **kwargs)
+            return _run(stage_name, match_position, func, args, kwargs)
+        return wrapper
+    return decorate
+
+if os.environ.get(INSTRUMENT_ENV):
+    enable(os.environ[INSTRUMENT_ENV], profile_stages=[s for s in os.environ.get(PROFILE_ENV, "").split(",") if s])
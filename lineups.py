@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+from parser import TACTICAL_EVENT_TYPES
+
+INTERVAL_COLUMNS = ["team_id", "team_name", "player_id", "player_name", "position_id", "position_name", "jersey_number",
+                    "on_period", "on_minute", "on_second", "off_period", "off_minute", "off_second", "on_time", "off_time", "on_event", "off_event"]
+CLOCK_COLUMNS = ["on_period", "on_minute", "on_second", "off_period", "off_minute", "off_second"]
+FORMATION_COLUMNS = ["team_id", "team_name", "formation", "on_time", "off_time", "on_event"]
+
+PERIOD_SPAN = 10000
+PERIOD_STARTS = {1: 0, 2: 45, 3: 90, 4: 105, 5: 120}
+
+def _match_time(period, minute, second):
+    '''Function to combine period, minute and second into one period-major sortable time.
+
+    StatsBomb clocks overlap between periods (first-half stoppage time runs past 45:00, where the
+    second half starts), so times are period * PERIOD_SPAN + seconds since kick-off.'''
+    return np.asarray(period, dtype=np.int64) * PERIOD_SPAN + np.asarray(minute, dtype=np.int64) * 60 + np.asarray(second, dtype=np.int64)
+
+def _event_time(df):
+    '''Function to compute the period-major time of every event; frames without a period count as period 1.'''
+    period = df["period"].to_numpy(dtype=np.int64) if "period" in df.columns else np.ones(len(df), dtype=np.int64)
+    return _match_time(period, df["minute"].to_numpy(dtype=np.int64), df["second"].to_numpy(dtype=np.int64))
+
+def _period_clock(times):
+    '''Function to split period-major times back into period, minute and second (NaN for infinite times).'''
+    times = pd.Series(times, dtype=float).where(lambda t: np.isfinite(t))
+    period, seconds = np.divmod(times, PERIOD_SPAN)
+    minute, second = np.divmod(seconds, 60)
+    return period, minute, second
+
+def _lineup_players(tactics):
+    '''Function to read the players of a Starting XI or Tactical Shift tactics dict.'''
+    return {
+        p["player"]["id"]: {
+            "player_id": p["player"]["id"],
+            "player_name": p["player"]["name"],
+            "position_id": p["position"]["id"],
+            "position_name": p["position"]["name"],
+            "jersey_number": p.get("jersey_number"),
+        }
+        for p in tactics.get("lineup", [])
+    }
+
+def build_lineup_intervals(df):
+    '''Function to build one row per stint a player spent on the pitch in one position.
+
+    Returns (intervals, formations). on_time and off_time are period-major times (see _match_time),
+    with the period, minute and second also given as columns; intervals are half-open
+    [on_time, off_time) and players still on at the end have off_time = inf.'''
+    tactical_events = df[df["type.name"].isin(TACTICAL_EVENT_TYPES)]
+    tactical_events = tactical_events.assign(_time=_event_time(tactical_events))
+    tactical_events = tactical_events.sort_values([c for c in ["period", "minute", "second", "index"] if c in df.columns], kind="stable")
+
+    intervals, formations = [], []
+    on_pitch, current_formation = {}, {}
+
+    def close(team_name, player_id, time, event_type):
+        stint = on_pitch[team_name].pop(player_id)
+        intervals.append({**stint, "off_time": time, "off_event": event_type})
+
+    def open_stint(team_name, team_id, player, time, event_type):
+        on_pitch[team_name][player["player_id"]] = {"team_id": team_id, "team_name": team_name, **player, "on_time": time, "on_event": event_type}
+
+    def set_formation(team_name, team_id, formation, time, event_type):
+        previous = current_formation.get(team_name)
+        if previous is not None and previous["formation"] == formation:
+            return
+        if previous is not None:
+            formations.append({**previous, "off_time": time})
+        current_formation[team_name] = {"team_id": team_id, "team_name": team_name, "formation": formation, "on_time": time, "on_event": event_type}
+
+    for event in tactical_events.to_dict('records'):
+        team_name, team_id, time = event["team_name"], event.get("team_id"), event["_time"]
+        event_type = event["type.name"]
+        team_on_pitch = on_pitch.setdefault(team_name, {})
+
+        if event_type in ("Starting XI", "Tactical Shift"):
+            players = _lineup_players(event["tactics"])
+            for player_id in list(team_on_pitch):
+                stint = team_on_pitch[player_id]
+                if player_id not in players or players[player_id]["position_id"] != stint["position_id"]:
+                    close(team_name, player_id, time, event_type)
+            for player_id, player in players.items():
+                if player_id not in team_on_pitch:
+                    open_stint(team_name, team_id, player, time, event_type)
+            set_formation(team_name, team_id, event["tactics"].get("formation"), time, event_type)
+
+        elif event_type == "Substitution":
+            outgoing = team_on_pitch.get(event.get("player_id"))
+            if outgoing is None:
+                outgoing = next((s for s in team_on_pitch.values() if s["player_name"] == event.get("player")), None)
+            if outgoing is not None:
+                close(team_name, outgoing["player_id"], time, event_type)
+            incoming = {
+                "player_id": event.get("substitution_replacement_id"),
+                "player_name": event.get("substitution_replacement"),
+                "position_id": outgoing["position_id"] if outgoing else np.nan,
+                "position_name": outgoing["position_name"] if outgoing else np.nan,
+                "jersey_number": None,
+            }
+            open_stint(team_name, team_id, incoming, time, event_type)
+
+    for team_name in on_pitch:
+        for player_id in list(on_pitch[team_name]):
+            close(team_name, player_id, np.inf, None)
+    for previous in current_formation.values():
+        formations.append({**previous, "off_time": np.inf})
+
+    intervals = pd.DataFrame(intervals, columns=[c for c in INTERVAL_COLUMNS if c not in CLOCK_COLUMNS])
+    intervals["on_time"] = intervals["on_time"].astype(float)
+    intervals["off_time"] = intervals["off_time"].astype(float)
+    intervals["on_period"], intervals["on_minute"], intervals["on_second"] = _period_clock(intervals["on_time"])
+    intervals["off_period"], intervals["off_minute"], intervals["off_second"] = _period_clock(intervals["off_time"])
+    intervals = intervals[INTERVAL_COLUMNS].sort_values(["team_name", "on_time", "player_id"], kind="stable").reset_index(drop=True)
+    formations = pd.DataFrame(formations, columns=FORMATION_COLUMNS).astype({"on_time": float, "off_time": float})
+    formations = formations.sort_values(["team_name", "on_time"], kind="stable").reset_index(drop=True)
+    return intervals, formations
+
+class LineupIndex:
+    '''Lookup of who was on the pitch, in which position and formation, at any time of a match.
+
+    Every change of lineup or formation starts a new lineup state per team; states are kept
+    sorted so events are matched to them with merge_asof instead of a per-event scan.'''
+
+    def __init__(self, intervals, formations):
+        self.intervals = intervals
+        self.formations = formations
+
+        boundaries = pd.concat([
+            intervals[["team_name", "on_time"]],
+            intervals.loc[np.isfinite(intervals["off_time"]), ["team_name", "off_time"]].rename(columns={"off_time": "on_time"}),
+            formations[["team_name", "on_time"]],
+        ]).drop_duplicates().sort_values(["team_name", "on_time"], kind="stable")
+        states = boundaries.rename(columns={"on_time": "start_time"}).reset_index(drop=True)
+        states["end_time"] = states.groupby("team_name")["start_time"].shift(-1).fillna(np.inf)
+        states["state_id"] = np.arange(len(states))
+        states = pd.merge_asof(states.sort_values("start_time"), formations[["team_name", "formation", "on_time"]].sort_values("on_time"),
+                               left_on="start_time", right_on="on_time", by="team_name").drop(columns="on_time")
+        self.states = states.sort_values("state_id").reset_index(drop=True)
+
+    @classmethod
+    def from_events(cls, df):
+        '''Function to build the index from a parsed match frame that still holds its tactical events.'''
+        return cls(*build_lineup_intervals(df))
+
+    def _active(self, team_name, time):
+        active = (self.intervals["team_name"] == team_name) & (self.intervals["on_time"] <= time) & (time < self.intervals["off_time"])
+        return self.intervals[active]
+
+    def on_pitch(self, team_name, minute, second=0, period=None):
+        '''Function to return the interval rows of the players on the pitch for a team at a given time.
+
+        Without a period, the latest period starting at or before minute is assumed, so first-half
+        stoppage time (period 1, minute 45+) needs period=1.'''
+        if period is None:
+            period = max(p for p, start in PERIOD_STARTS.items() if start <= minute)
+        return self._active(team_name, _match_time(period, minute, second))
+
+    def state_players(self, state_id):
+        '''Function to return the players on the pitch during one lineup state.'''
+        state = self.states.loc[state_id]
+        return self._active(state["team_name"], state["start_time"])
+
+    def attach(self, df):
+        '''Function to add lineup_state, formation, player_position_id/name and player_on_pitch to every event in one join.'''
+        events = pd.DataFrame({
+            "_row": np.arange(len(df)),
+            "_time": _event_time(df).astype(float),
+            "team_name": df["team_name"].to_numpy(dtype=object),
+            "player_id": pd.to_numeric(df["player_id"], errors="coerce").to_numpy(dtype=float) if "player_id" in df.columns else np.nan,
+        }).sort_values("_time", kind="stable")
+
+        states = self.states[["team_name", "start_time", "state_id", "formation"]].sort_values("start_time")
+        events = pd.merge_asof(events, states, left_on="_time", right_on="start_time", by="team_name")
+
+        stints = self.intervals[["team_name", "player_id", "position_id", "position_name", "on_time", "off_time"]]
+        stints = stints.astype({"player_id": float}).sort_values("on_time")
+        events = pd.merge_asof(events, stints, left_on="_time", right_on="on_time", by=["team_name", "player_id"])
+        events = events.sort_values("_row")
+        on_pitch = (events["_time"] < events["off_time"]).to_numpy()
+
+        return df.assign(
+            lineup_state=events["state_id"].to_numpy(),
+            formation=events["formation"].to_numpy(),
+            player_position_id=events["position_id"].where(on_pitch).to_numpy(),
+            player_position_name=events["position_name"].where(on_pitch).to_numpy(),
+            player_on_pitch=on_pitch,
+        )
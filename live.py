@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from scipy.sparse import csr_matrix
+from loader import _flatten_event
+from metrics import (_flux_cells, _heatmap_cells, _zone_codes, _zone_usage_frame, _zone_counts_table,
+                     CHANNEL_LABELS, THIRD_LABELS)
+
+PASS_COLUMNS = ["location_x", "location_y", "pass_end_location_x", "pass_end_location_y"]
+
+def _coordinate(event, column, list_column, index):
+    '''Function to read one coordinate from a parsed event (location_x) or a raw one (location list).'''
+    value = event.get(column)
+    if value is None:
+        values = event.get(list_column)
+        value = values[index] if isinstance(values, (list, tuple)) and len(values) > index else np.nan
+    return np.nan if value is None else float(value)
+
+def _event_fields(event):
+    '''Function to pull team, type, minute and coordinates out of an event mapping.
+
+    Accepts parsed rows (location_x), sb.events-flattened rows (location lists) and raw StatsBomb
+    events from a live feed (team and type as {"id", "name"} dicts, pass details nested under
+    "pass"), which are flattened like the open-data loader does first.'''
+    if isinstance(event.get("type"), dict):
+        event = _flatten_event(dict(event), event.get("match_id"))
+    return {
+        "team_name": event.get("team_name", event.get("team")),
+        "type.name": event.get("type.name", event.get("type")),
+        "minute": int(event["minute"]),
+        "location_x": _coordinate(event, "location_x", "location", 0),
+        "location_y": _coordinate(event, "location_y", "location", 1),
+        "pass_end_location_x": _coordinate(event, "pass_end_location_x", "pass_end_location", 0),
+        "pass_end_location_y": _coordinate(event, "pass_end_location_y", "pass_end_location", 1),
+    }
+
+def _as_columns(rows):
+    '''Function to turn a list of _event_fields dicts into column arrays.'''
+    return {
+        k: np.array([row[k] for row in rows], dtype=object if k in ("team_name", "type.name") else float)
+        for k in rows[0]
+    }
+
+class _Window:
+    '''Running pass counts for one team and time window.'''
+
+    def __init__(self, n_cells):
+        self.lanes = np.zeros((n_cells, n_cells), dtype=np.int64)
+        self.channel = np.zeros(3, dtype=np.int64)
+        self.third = np.zeros(3, dtype=np.int64)
+        self.zone = np.zeros(9, dtype=np.int64)
+        self.dirty = True
+        self.snapshot = None
+
+class LiveAccumulator:
+    '''Stateful heatmap, zone and pass flux counts for a match that is still being played.
+
+    Events are added one at a time with add_event or in small batches with add_events; every
+    event costs a constant amount of work. heatmaps, minute_heatmaps and windowed_metrics return
+    the same structures as compute_heatmap and compute_windowed_metrics on the events seen so far,
+    rebuilding only the windows that changed since the last snapshot.'''
+
+    def __init__(self, grid_size=8, window_size=15):
+        self.grid_size = grid_size
+        self.window_size = window_size
+        self.n_cells = grid_size * grid_size
+        self.n_events = 0
+        self._heat = defaultdict(lambda: np.zeros(self.n_cells, dtype=np.int64))
+        self._minute_heat = defaultdict(lambda: defaultdict(lambda: np.zeros(self.n_cells, dtype=np.int64)))
+        self._windows = defaultdict(dict)
+
+    def _window(self, team_name, block_index):
+        window = self._windows[team_name].get(block_index)
+        if window is None:
+            window = self._windows[team_name][block_index] = _Window(self.n_cells)
+        return window
+
+    def add_event(self, event):
+        '''Function to add one event, given as a mapping in parsed, sb.events-flattened or raw StatsBomb form.'''
+        self._add_arrays(_as_columns([_event_fields(event)]))
+
+    def add_events(self, events):
+        '''Function to add a batch of events, given as a parsed DataFrame or an iterable of event mappings.'''
+        if isinstance(events, pd.DataFrame):
+            columns = {c: events[c].to_numpy() for c in ["team_name", "type.name", "minute"] + PASS_COLUMNS if c in events.columns}
+            for column in PASS_COLUMNS:
+                columns.setdefault(column, np.full(len(events), np.nan))
+            columns = {k: v.astype(float) if k in PASS_COLUMNS else v for k, v in columns.items()}
+        else:
+            rows = [_event_fields(event) for event in events]
+            if not rows:
+                return
+            columns = _as_columns(rows)
+        self._add_arrays(columns)
+
+    def _add_arrays(self, columns):
+        '''Function to fold a batch of events, as column arrays, into the running counts.'''
+        teams = columns["team_name"]
+        minutes = columns["minute"].astype(np.int64)
+        self.n_events += len(teams)
+        has_team = pd.notna(teams)
+
+        cells, inside = _heatmap_cells(columns["location_x"], columns["location_y"], self.grid_size)
+        for i in np.flatnonzero(has_team & inside):
+            self._heat[teams[i]][cells[i]] += 1
+            self._minute_heat[teams[i]][int(minutes[i])][cells[i]] += 1
+
+        located = ~np.isnan(np.column_stack([columns[c] for c in PASS_COLUMNS])).any(axis=1)
+        passes = np.flatnonzero(has_team & located & (columns["type.name"] == "Pass"))
+        if not len(passes):
+            return
+        starts_flat, ends_flat, in_grid = _flux_cells({c: columns[c][passes] for c in PASS_COLUMNS}, self.grid_size)
+        channels = _zone_codes(columns["location_x"][passes])
+        thirds = _zone_codes(columns["location_y"][passes])
+        for j, i in enumerate(passes):
+            window = self._window(teams[i], int(minutes[i]) // self.window_size)
+            if in_grid[j]:
+                window.lanes[starts_flat[j], ends_flat[j]] += 1
+            window.channel[channels[j]] += 1
+            window.third[thirds[j]] += 1
+            window.zone[channels[j] * 3 + thirds[j]] += 1
+            window.dirty = True
+
+    def heatmaps(self):
+        '''Function to return per-team heatmaps of all events so far, like compute_heatmap.'''
+        return {team: heat.reshape(self.grid_size, self.grid_size).astype(float) for team, heat in sorted(self._heat.items())}
+
+    def minute_heatmaps(self):
+        '''Function to return per-team, per-minute heatmaps of all events so far.'''
+        return {
+            team: {minute: heat.reshape(self.grid_size, self.grid_size).astype(float) for minute, heat in sorted(minutes.items())}
+            for team, minutes in sorted(self._minute_heat.items())
+        }
+
+    def windowed_metrics(self):
+        '''Function to return windowed pass fluxes of all passes so far, like compute_windowed_metrics.'''
+        windowed_pass_fluxes = defaultdict(dict)
+        for team_name in sorted(self._windows):
+            for block_index in sorted(self._windows[team_name]):
+                window = self._windows[team_name][block_index]
+                if window.dirty:
+                    start_minute = block_index * self.window_size
+                    window.snapshot = {
+                        "flux": csr_matrix(window.lanes),
+                        "channel": _zone_usage_frame(window.channel[:, None], CHANNEL_LABELS, [team_name], "channel"),
+                        "third": _zone_usage_frame(window.third[:, None], THIRD_LABELS, [team_name], "third"),
+                        "zone": _zone_counts_table(window.zone, [team_name]),
+                        "window": (start_minute, start_minute + self.window_size - 1),
+                    }
+                    window.dirty = False
+                windowed_pass_fluxes[team_name][block_index] = window.snapshot
+        return windowed_pass_fluxes
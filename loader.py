@@ -0,0 +1,194 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+CACHE_FORMAT_VERSION = 1
+STREAMING_THRESHOLD_BYTES = 8 * 1024 * 1024
+NAMED_ID_KEYS = ["possession_team", "player", "team", "pass_recipient", "substitution_outcome", "substitution_replacement"]
+
+def _flatten_event(event, match_id):
+    '''Function to flatten one raw StatsBomb event the same way statsbombpy's sb.events does.'''
+    ev_type = event["type"]["name"].lower().replace(" ", "_").replace("*", "")
+    ev_type = ev_type if event["type"]["name"] != "Goal Keeper" else "goalkeeper"
+    if ev_type in event:
+        for k, v in event.pop(ev_type).items():
+            event[f"{ev_type}_{k}"] = v
+
+    for k, v in list(event.items()):
+        if isinstance(v, dict) and "name" in v:
+            event[k] = v["name"]
+            if k in NAMED_ID_KEYS:
+                event[f"{k}_id"] = v["id"]
+    event["match_id"] = match_id
+    return event
+
+def _iter_json_array(path):
+    '''Function to iterate over the items of a top-level JSON array, streaming large files when ijson is available.'''
+    with open(path, 'rb') as f:
+        if ijson is not None and os.path.getsize(path) >= STREAMING_THRESHOLD_BYTES:
+            yield from ijson.items(f, 'item', use_float=True)
+        else:
+            yield from json.load(f)
+
+def read_open_data_events(match_id, data_dir):
+    '''Function to read a match's events from a local StatsBomb open-data checkout into a flat DataFrame.'''
+    path = Path(data_dir) / "events" / f"{match_id}.json"
+    events = [_flatten_event(event, match_id) for event in _iter_json_array(path)]
+    events_df = pd.DataFrame(events)
+    return events_df[sorted(events_df.columns)]
+
+def read_open_data_matches(competition_id, season_id, data_dir):
+    '''Function to read the match list for a competition season from a local StatsBomb open-data checkout.'''
+    path = Path(data_dir) / "matches" / str(competition_id) / f"{season_id}.json"
+    return pd.json_normalize(list(_iter_json_array(path)), sep="_")
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _column_kind(values):
+    '''Function to choose how an object column is stored: "coords", "category" or "json".'''
+    present = [v for v in values if not (isinstance(v, float) and np.isnan(v)) and v is not None]
+    if not present:
+        return "category"
+    if all(isinstance(v, list) and v and all(map(_is_number, v)) for v in present):
+        return "coords"
+    if all(isinstance(v, (str, bool, int, float)) for v in present):
+        return "category"
+    return "json"
+
+def _code_dtype(n_categories):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def save_event_cache(events_df, match_id, cache_dir, source_path=None):
+    '''Function to save a match's events as one .npy file per column under cache_dir/<match_id>.
+
+    Numeric columns are stored as-is, scalar object columns as integer codes plus a category list,
+    coordinate lists as NaN-padded float arrays and anything else (dicts, id lists) as JSON.'''
+    match_path = Path(cache_dir) / str(match_id)
+    tmp_path = Path(cache_dir) / f".{match_id}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    columns = {}
+    for i, column in enumerate(events_df.columns):
+        series = events_df[column]
+        filename = f"{i:03d}"
+        if pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            np.save(tmp_path / f"{filename}.npy", series.to_numpy())
+            columns[column] = {"kind": "numeric", "file": filename}
+            continue
+
+        values = series.to_numpy(dtype=object)
+        kind = _column_kind(values)
+        if kind == "category":
+            codes, categories = pd.factorize(series, use_na_sentinel=True)
+            np.save(tmp_path / f"{filename}.npy", codes.astype(_code_dtype(len(categories))))
+            columns[column] = {"kind": kind, "file": filename, "categories": [c.item() if isinstance(c, np.generic) else c for c in categories]}
+        elif kind == "coords":
+            width = max(len(v) for v in values if isinstance(v, list))
+            coords = np.full((len(values), width), np.nan)
+            for row, v in enumerate(values):
+                if isinstance(v, list):
+                    coords[row, :len(v)] = v
+            np.save(tmp_path / f"{filename}.npy", coords)
+            columns[column] = {"kind": kind, "file": filename}
+        else:
+            with open(tmp_path / f"{filename}.json", 'w') as f:
+                json.dump([None if isinstance(v, float) and np.isnan(v) else v for v in values], f)
+            columns[column] = {"kind": kind, "file": filename}
+
+    meta = {
+        "format_version": CACHE_FORMAT_VERSION,
+        "match_id": match_id,
+        "n_rows": len(events_df),
+        "source": _source_stamp(source_path) if source_path is not None else None,
+        "columns": columns,
+    }
+    with open(tmp_path / "meta.json", 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(match_path, ignore_errors=True)
+    os.replace(tmp_path, match_path)
+    return match_path
+
+def read_event_cache_meta(match_id, cache_dir):
+    '''Function to read the metadata of a cached match, or None when it is not cached.'''
+    meta_path = Path(cache_dir) / str(match_id) / "meta.json"
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("format_version") != CACHE_FORMAT_VERSION:
+        return None
+    return meta
+
+def load_event_cache(match_id, cache_dir, columns=None, mmap=True):
+    '''Function to load a cached match, reading only the requested columns.
+
+    Numeric columns are memory-mapped when mmap is True; coordinate columns come back as lists
+    so the frame can go straight into parse_events.'''
+    meta = read_event_cache_meta(match_id, cache_dir)
+    if meta is None:
+        raise FileNotFoundError(f"Match {match_id} is not in the event cache at {cache_dir}")
+    match_path = Path(cache_dir) / str(match_id)
+    wanted = list(meta["columns"]) if columns is None else [c for c in columns if c in meta["columns"]]
+
+    data = {}
+    for column in wanted:
+        info = meta["columns"][column]
+        if info["kind"] == "json":
+            with open(match_path / f"{info['file']}.json") as f:
+                values = json.load(f)
+            data[column] = pd.Series([np.nan if v is None else v for v in values], dtype=object)
+            continue
+
+        array = np.load(match_path / f"{info['file']}.npy", mmap_mode='r' if mmap else None)
+        if info["kind"] == "numeric":
+            data[column] = pd.Series(array, copy=False)
+        elif info["kind"] == "category":
+            categories = np.empty(len(info["categories"]) + 1, dtype=object)
+            categories[:-1] = info["categories"]
+            categories[-1] = np.nan
+            data[column] = pd.Series(categories[array], dtype=object)
+        else:
+            values = [[v for v in row if v == v] or np.nan for row in array.tolist()]
+            data[column] = pd.Series(values, dtype=object)
+
+    return pd.DataFrame(data, copy=False)
+
+def cached_match_ids(cache_dir):
+    '''Function to list the match ids currently held in the event cache.'''
+    cache_path = Path(cache_dir)
+    if not cache_path.exists():
+        return []
+    return sorted(int(p.name) for p in cache_path.iterdir() if p.is_dir() and p.name.isdigit() and (p / "meta.json").exists())
+
+def load_events_offline(match_id, data_dir, cache_dir=None, columns=None, mmap=True):
+    '''Function to load a match from local open-data files, going through the columnar cache when cache_dir is set.'''
+    if cache_dir is None:
+        events_df = read_open_data_events(match_id, data_dir)
+        return events_df if columns is None else events_df[[c for c in columns if c in events_df.columns]]
+
+    source_path = Path(data_dir) / "events" / f"{match_id}.json" if data_dir is not None else None
+    meta = read_event_cache_meta(match_id, cache_dir)
+    stale = meta is None or (source_path is not None and source_path.exists() and meta.get("source") != _source_stamp(source_path))
+    if stale:
+        if source_path is None:
+            raise FileNotFoundError(f"Match {match_id} is not in the event cache at {cache_dir} and no data_dir was given")
+        save_event_cache(read_open_data_events(match_id, data_dir), match_id, cache_dir, source_path=source_path)
+    return load_event_cache(match_id, cache_dir, columns=columns, mmap=mmap)
@@ -1,4 +1,5 @@
 import json
+import os
 import pandas as pd 
 import numpy as np
 from collections import defaultdict
@@ -10,7 +11,9 @@ from pathlib import Path
 from datetime import datetime
 
 match_id = 3942819
-events_df = load_events(match_id=3942819)
+data_dir = os.environ.get("STATSBOMB_DATA_DIR")
+cache_dir = os.environ.get("EVENT_CACHE_DIR")
+events_df = load_events(match_id=match_id, data_dir=data_dir, cache_dir=cache_dir)
 events_df_final = parse_events(events_df)
 
 tactics_df_final, main_df_final = extract_tactics(events_df_final)
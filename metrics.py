@@ -1,20 +1,146 @@
 import numpy as np
 import pandas as pd
 from collections import defaultdict
-from scipy.sparse import coo_matrix
+from scipy.fft import irfftn, next_fast_len, rfftn
+from scipy.sparse import coo_matrix, csr_matrix
+from instrument import stage
 
+@stage()
 def compute_heatmap(df, by='team_name', grid_size=8):
     '''Function to compute heatmaps for given DataFrame. '''
     heatmaps = {}
     xedges = np.linspace(0,100, grid_size+1)
     yedges = np.linspace(0,100, grid_size+1)
-    for key, group in df.groupby(by):
+    for key, group in df.groupby(by, observed=True):
         xs = group["location_x"].dropna()
         ys = group["location_y"].dropna()
         heat, _, _ = np.histogram2d(xs, ys, bins=[xedges, yedges])
         heatmaps[key] = heat
     return heatmaps
 
+@stage()
+def compute_heatmap_tensor(df, by='team_name', grid_size=8, sparse=False):
+    '''Function to compute the heatmaps of every group in one bincount.
+
+    Returns (heatmaps, entities): heatmaps is a dense (n_entities, grid_size, grid_size) array, or a
+    (n_entities, grid_size * grid_size) CSR matrix when sparse is True, and entities is the sorted
+    pd.Index (MultiIndex when by is a list) of group keys, so entities.get_loc(key) gives the row
+    holding the same heatmap compute_heatmap returns for that key.'''
+    grouped = df.groupby(by, sort=True, observed=True)
+    entities = grouped.size().index
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    n_cells = grid_size * grid_size
+
+    cells, mask = _heatmap_cells(df["location_x"], df["location_y"], grid_size)
+    mask &= codes >= 0
+    if sparse:
+        data = np.ones(int(mask.sum()), dtype=np.int64)
+        heatmaps = coo_matrix((data, (codes[mask], cells[mask])), shape=(len(entities), n_cells)).tocsr()
+        return heatmaps, entities
+    counts = np.bincount(codes[mask] * n_cells + cells[mask], minlength=len(entities) * n_cells)
+    return counts.reshape(len(entities), grid_size, grid_size).astype(float), entities
+
+def _heatmap_cells(xs, ys, grid_size=8):
+    '''Function to compute flattened heatmap cells with the same binning as compute_heatmap, and the mask of points inside the grid.'''
+    edges = np.linspace(0, 100, grid_size+1)
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    xi = np.searchsorted(edges, xs, side="right") - 1
+    yi = np.searchsorted(edges, ys, side="right") - 1
+    xi[xs == edges[-1]] -= 1
+    yi[ys == edges[-1]] -= 1
+    mask = (xi >= 0) & (xi < grid_size) & (yi >= 0) & (yi < grid_size)
+    return xi * grid_size + yi, mask
+
+PITCH_LENGTH = 120
+PITCH_WIDTH = 80
+DENSITY_BINS = (120, 80)
+
+def _grid_shape(grid_size):
+    '''Function to accept a square grid size or an (nx, ny) pair.'''
+    return (grid_size, grid_size) if np.isscalar(grid_size) else tuple(grid_size)
+
+def _pitch_cells(xs, ys, bins=DENSITY_BINS):
+    '''Function to compute flattened cells on a pitch-sized (120 x 80) grid, and the mask of points on the pitch.'''
+    nx, ny = bins
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    mask = (xs >= 0) & (xs <= PITCH_LENGTH) & (ys >= 0) & (ys <= PITCH_WIDTH)
+    xi = np.minimum(np.floor(np.where(mask, xs, 0) * nx / PITCH_LENGTH).astype(np.int64), nx - 1)
+    yi = np.minimum(np.floor(np.where(mask, ys, 0) * ny / PITCH_WIDTH).astype(np.int64), ny - 1)
+    return xi * ny + yi, mask
+
+def _gaussian_kernel_fft(padded, sigma, radius):
+    '''Function to return the rfft of a normalised Gaussian kernel centred on cell (0, 0) of a padded grid and cut at radius cells.'''
+    offsets = [np.minimum(np.arange(n), n - np.arange(n)) for n in padded]
+    kernel = np.exp(-0.5 * ((offsets[0][:, None] / sigma[0]) ** 2 + (offsets[1][None, :] / sigma[1]) ** 2))
+    kernel[(offsets[0][:, None] > radius[0]) | (offsets[1][None, :] > radius[1])] = 0
+    return rfftn(kernel / kernel.sum())
+
+def smooth_density(counts, bandwidth=2.0, bins=DENSITY_BINS, batch_size=256):
+    '''Function to smooth a (n, nx, ny) stack of pitch histograms with a Gaussian of bandwidth pitch units.
+
+    The convolution runs as one zero-padded FFT per batch of batch_size histograms, so its cost does
+    not depend on the number of events; the kernel is truncated at four bandwidths and mass smoothed
+    past the touchlines is dropped.'''
+    counts = np.asarray(counts, dtype=float)
+    if bandwidth <= 0 or not len(counts):
+        return counts
+    sigma = (bandwidth * bins[0] / PITCH_LENGTH, bandwidth * bins[1] / PITCH_WIDTH)
+    radius = tuple(int(np.ceil(4 * s)) for s in sigma)
+    padded = tuple(next_fast_len(n + r) for n, r in zip(bins, radius))
+    kernel = _gaussian_kernel_fft(padded, sigma, radius)
+    smoothed = np.empty_like(counts)
+    for start in range(0, len(counts), batch_size):
+        batch = rfftn(counts[start:start + batch_size], s=padded, axes=(1, 2))
+        smoothed[start:start + batch_size] = irfftn(batch * kernel, s=padded, axes=(1, 2))[:, :bins[0], :bins[1]]
+    return np.maximum(smoothed, 0)
+
+def _overlap_weights(n_fine, n_coarse):
+    '''Function to return the (n_coarse, n_fine) share of every fine bin that falls in each coarse bin along one axis.'''
+    edges = np.arange(n_coarse + 1) * n_fine / n_coarse
+    fine = np.arange(n_fine + 1)
+    return np.clip(np.minimum(edges[1:, None], fine[None, 1:]) - np.maximum(edges[:-1, None], fine[None, :-1]), 0, None)
+
+def pool_density(density, grid_size=8):
+    '''Function to sum a (n, nx, ny) fine density into a coarser grid_size grid (square or (gx, gy)).
+
+    Fine bins straddling a coarse edge are split by overlapping area, so any grid works (6 and 12
+    do not divide the 80 bins across the pitch) and the total is preserved; when a grid dimension
+    divides the fine one this is a plain block sum.'''
+    gx, gy = _grid_shape(grid_size)
+    n, nx, ny = density.shape
+    if gx > nx or gy > ny:
+        raise ValueError(f"grid {gx}x{gy} is finer than the {nx}x{ny} density grid")
+    return _overlap_weights(nx, gx) @ density @ _overlap_weights(ny, gy).T
+
+@stage()
+def compute_density_tensor(df, by='team_name', bandwidth=2.0, bins=DENSITY_BINS, grid_sizes=(8,), batch_size=256):
+    '''Function to compute Gaussian-smoothed heatmaps of every group on the 120 x 80 pitch.
+
+    Events are histogrammed once per group on the fine bins grid with one bincount, smoothed with a
+    batched FFT convolution (bandwidth in pitch units, 0 for raw counts), and each of grid_sizes is
+    pooled from the fine grid. Returns (densities, entities): densities maps "fine" and every grid
+    size to an (n_entities, nx, ny) array, and entities is indexed like compute_heatmap_tensor.'''
+    nx, ny = _grid_shape(bins)
+    grouped = df.groupby(by, sort=True, observed=True)
+    entities = grouped.size().index
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+    cells, mask = _pitch_cells(df["location_x"], df["location_y"], (nx, ny))
+    mask &= codes >= 0
+    counts = np.bincount(codes[mask] * nx * ny + cells[mask], minlength=len(entities) * nx * ny)
+    fine = smooth_density(counts.reshape(len(entities), nx, ny), bandwidth, (nx, ny), batch_size)
+    densities = {"fine": fine}
+    for grid_size in grid_sizes:
+        densities[grid_size] = pool_density(fine, grid_size)
+    return densities, entities
+
+def compute_density_heatmap(df, by='team_name', grid_size=8, bandwidth=2.0, bins=DENSITY_BINS):
+    '''Function to compute smoothed heatmaps keyed like compute_heatmap, on a pitch-correct grid pooled from the fine density.'''
+    densities, entities = compute_density_tensor(df, by, bandwidth, bins, grid_sizes=(grid_size,))
+    return {key: densities[grid_size][i] for i, key in enumerate(entities)}
+
 def assign_channel(x):
     '''Function to assign a channel based on x-coordinate.'''
     if x <33.33:
@@ -33,19 +159,99 @@ def assign_third(y):
     else:
         return "final"
 
+CHANNEL_LABELS = np.array(["left", "middle", "right"], dtype=object)
+THIRD_LABELS = np.array(["defensive", "middle", "final"], dtype=object)
+SCHEMA_CHANNEL_LABELS = np.array(["left", "centre", "right"], dtype=object)
+
+def _zone_codes(values):
+    '''Function to map coordinates to 0/1/2 band codes with the same cut points as assign_channel and assign_third.'''
+    values = np.asarray(values, dtype=float)
+    return (2 - (values < 66.66).astype(np.int8) - (values < 33.33).astype(np.int8)).astype(np.int8)
+
+def classify_zones(df, as_categorical=False):
+    '''Function to label every row with channel, third and combined zone (channel * 3 + third) codes.
+
+    Codes are int8 with the order of CHANNEL_LABELS and THIRD_LABELS; as_categorical returns labelled categoricals
+    instead, using the schema's zone vocabulary (SCHEMA_CHANNEL_LABELS, so "centre" rather than "middle").'''
+    channel = _zone_codes(df["location_x"])
+    third = _zone_codes(df["location_y"])
+    zone = channel * 3 + third
+    if as_categorical:
+        zone_labels = [f"{c}_{t}" for c in SCHEMA_CHANNEL_LABELS for t in THIRD_LABELS]
+        return pd.DataFrame({
+            "channel": pd.Categorical.from_codes(channel, SCHEMA_CHANNEL_LABELS),
+            "third": pd.Categorical.from_codes(third, THIRD_LABELS),
+            "zone": pd.Categorical.from_codes(zone, zone_labels),
+        }, index=df.index)
+    return pd.DataFrame({"channel": channel, "third": third, "zone": zone}, index=df.index)
+
+def _zone_usage_frame(counts, labels, keys, name, by="team_name"):
+    '''Function to build a (zones present x keys) usage table laid out like groupby([name, by]).size().unstack(fill_value=0).'''
+    present = counts.sum(axis=1) > 0
+    order = np.argsort(labels[present], kind="stable")
+    index = pd.Index(labels[present][order].tolist(), name=name)
+    return pd.DataFrame(counts[present][order].astype(np.int64), index=index, columns=pd.Index(keys, name=by))
+
+def _zone_usage_frames(counts, labels, keys, name, by="team_name"):
+    '''Function to build one single-key usage table per row of (n, 3) counts, laid out like _zone_usage_frame.
+
+    Row and column indexes are built once per distinct layout and shared between tables, which keeps
+    the per-table cost to a single block DataFrame construction.'''
+    row_indexes, column_indexes, frames = {}, {}, []
+    for row, key in zip(counts, keys):
+        present = row > 0
+        pattern = present.tobytes()
+        if pattern not in row_indexes:
+            order = np.argsort(labels[present], kind="stable")
+            row_indexes[pattern] = (np.flatnonzero(present)[order], pd.Index(labels[present][order].tolist(), name=name))
+        if key not in column_indexes:
+            column_indexes[key] = pd.Index([key], name=by)
+        positions, index = row_indexes[pattern]
+        frames.append(pd.DataFrame(row[positions][:, None].astype(np.int64), index=index, columns=column_indexes[key]))
+    return frames
+
+def _factorize_keys(values):
+    '''Function to factorize a key column, returning plain (non-categorical) keys for categorical columns too.'''
+    key_codes, keys = pd.factorize(values, sort=True)
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        keys = pd.Index(np.asarray(keys))
+    return key_codes, keys
+
+def _zone_usage(codes, df, labels, name, by="team_name"):
+    '''Function to count band codes per value of the by column with one bincount.'''
+    key_codes, keys = _factorize_keys(df[by])
+    keep = key_codes >= 0
+    counts = np.bincount(codes[keep] * len(keys) + key_codes[keep], minlength=3 * len(keys))
+    return _zone_usage_frame(counts.reshape(3, len(keys)), labels, keys, name, by)
+
 def _compute_channel_usage(df, by="team_name"):
     '''Function to compute channel usage based on x-coordinate.'''
-    df = df.copy()
-    df["channel"] = df["location_x"].apply(assign_channel)
-    return df.groupby(["channel", by]).size().unstack(fill_value=0)
+    return _zone_usage(_zone_codes(df["location_x"]), df, CHANNEL_LABELS, "channel", by)
 
 def _compute_third_usage(df, by="team_name"):
     '''Function to compute third usage based on y-coordinate.'''
-    df = df.copy()
-    df["third"] = df["location_y"].apply(assign_third)
-    return df.groupby(["third", by]).size().unstack(fill_value=0)    
+    return _zone_usage(_zone_codes(df["location_y"]), df, THIRD_LABELS, "third", by)
 
-def _calculate_flux_matrix(df_pass, grid_size=8):
+def _zone_counts_table(counts, keys, by="team_name"):
+    '''Function to turn (keys x 9) zone counts into the tidy zone_counts layout of schema.md.'''
+    keys = np.asarray(keys, dtype=object)
+    return pd.DataFrame({
+        by: np.repeat(keys, 9),
+        "vertical_channel": np.tile(np.repeat(SCHEMA_CHANNEL_LABELS, 3), len(keys)),
+        "horizontal_third": np.tile(np.tile(THIRD_LABELS, 3), len(keys)),
+        "count": counts.reshape(-1).astype(np.int64),
+    })
+
+def _compute_zone_usage(df, by="team_name"):
+    '''Function to compute joint channel-by-third usage, one row per key and zone as in the zone_usage schema.'''
+    zones = classify_zones(df)["zone"].to_numpy()
+    key_codes, keys = _factorize_keys(df[by])
+    keep = key_codes >= 0
+    counts = np.bincount(key_codes[keep] * 9 + zones[keep], minlength=9 * len(keys))
+    return _zone_counts_table(counts.reshape(len(keys), 9), keys, by)
+
+def _flux_cells(df_pass, grid_size=8):
+    '''Function to compute flattened start and end cells of passes, and the mask of passes inside the grid.'''
     xbins = np.linspace(0, 100, grid_size+1)
     ybins = np.linspace(0, 100, grid_size+1)
 
@@ -59,6 +265,11 @@ def _calculate_flux_matrix(df_pass, grid_size=8):
 
     max_index = grid_size * grid_size
     mask = (starts_flat >= 0) & (starts_flat < max_index) & (ends_flat >= 0) & (ends_flat < max_index)
+    return starts_flat, ends_flat, mask
+
+def _calculate_flux_matrix(df_pass, grid_size=8):
+    starts_flat, ends_flat, mask = _flux_cells(df_pass, grid_size)
+    max_index = grid_size * grid_size
 
     starts_filtered = starts_flat[mask]
     ends_filtered = ends_flat[mask]
@@ -69,16 +280,18 @@ def _calculate_flux_matrix(df_pass, grid_size=8):
 
     return flux_csr
 
+@stage()
 def compute_windowed_metrics(df, window_size=15, grid_size=8):
     '''Function to compute windowed pass fluxes.'''
     windowed_pass_fluxes = defaultdict(dict)
-    dfp = df[df["type.name"] == "Pass"].dropna(subset=["location_x", "location_y", "pass_end_location_x", "pass_end_location_y"]).copy()
-    dfp["time_block"] = dfp["minute"] // window_size
+    dfp = df[df["type.name"] == "Pass"].dropna(subset=["location_x", "location_y", "pass_end_location_x", "pass_end_location_y"])
+    time_block = (dfp["minute"] // window_size).astype(np.int64).rename("time_block")
 
-    for (team_name, block_index), group in dfp.groupby(["team_name", "time_block"]):
+    for (team_name, block_index), group in dfp.groupby([dfp["team_name"], time_block], observed=True):
         flux = _calculate_flux_matrix(group, grid_size)
         channel = _compute_channel_usage(group)
         third = _compute_third_usage(group)
+        zone = _compute_zone_usage(group)
 
         start_minute = block_index * window_size
         end_minute = start_minute + window_size - 1
@@ -87,6 +300,69 @@ def compute_windowed_metrics(df, window_size=15, grid_size=8):
             "flux": flux,
             "channel": channel,
             "third": third,
+            "zone": zone,
+            "window": (start_minute, end_minute)
+        }
+
+    return windowed_pass_fluxes
+
+@stage()
+def compute_windowed_metrics_fused(df, window_size=15, grid_size=8):
+    '''Function to compute the same windowed pass fluxes as compute_windowed_metrics, binning every pass once.
+
+    Every pass gets a composite (team, window, from_cell, to_cell) key, all flux matrices come from one
+    np.unique over those keys and the channel, third and zone counts from one np.bincount each. The zone
+    tables of all windows are built as one frame and sliced per window.'''
+    windowed_pass_fluxes = defaultdict(dict)
+    dfp = df[df["type.name"] == "Pass"].dropna(subset=["location_x", "location_y", "pass_end_location_x", "pass_end_location_y"])
+
+    team_codes, teams = _factorize_keys(dfp["team_name"])
+    block_values, block_codes = np.unique(dfp["minute"].to_numpy().astype(np.int64) // window_size, return_inverse=True)
+    keep = team_codes >= 0
+    if not keep.any():
+        return windowed_pass_fluxes
+
+    n_blocks = len(block_values)
+    n_groups = len(teams) * n_blocks
+    n_cells = grid_size * grid_size
+    groups = team_codes * n_blocks + block_codes.ravel()
+
+    starts_flat, ends_flat, mask = _flux_cells(dfp, grid_size)
+    mask = mask & keep
+    keys = (groups[mask].astype(np.int64) * n_cells + starts_flat[mask]) * n_cells + ends_flat[mask]
+    keys, counts = np.unique(keys, return_counts=True)
+    key_groups, cells = np.divmod(keys, n_cells * n_cells)
+    rows, cols = np.divmod(cells, n_cells)
+    group_bounds = np.searchsorted(key_groups, np.arange(n_groups + 1))
+
+    zone_codes = classify_zones(dfp)[keep]
+    group_sizes = np.bincount(groups[keep], minlength=n_groups)
+    channels = np.bincount(groups[keep] * 3 + zone_codes["channel"].to_numpy(), minlength=n_groups * 3).reshape(n_groups, 3)
+    thirds = np.bincount(groups[keep] * 3 + zone_codes["third"].to_numpy(), minlength=n_groups * 3).reshape(n_groups, 3)
+    zones = np.bincount(groups[keep] * 9 + zone_codes["zone"].to_numpy(), minlength=n_groups * 9).reshape(n_groups, 9)
+
+    groups_present = np.flatnonzero(group_sizes)
+    group_teams = np.asarray(teams, dtype=object)[groups_present // n_blocks]
+    channel_frames = _zone_usage_frames(channels[groups_present], CHANNEL_LABELS, group_teams, "channel")
+    third_frames = _zone_usage_frames(thirds[groups_present], THIRD_LABELS, group_teams, "third")
+    zone_table = _zone_counts_table(zones[groups_present], group_teams)
+    zone_index = pd.RangeIndex(9)
+
+    for i, group in enumerate(groups_present):
+        team_name = teams[group // n_blocks]
+        block_index = block_values[group % n_blocks]
+        lo, hi = group_bounds[group], group_bounds[group + 1]
+        indptr = np.searchsorted(rows[lo:hi], np.arange(n_cells + 1))
+        flux = csr_matrix((counts[lo:hi], cols[lo:hi], indptr), shape=(n_cells, n_cells))
+
+        start_minute = block_index * window_size
+        end_minute = start_minute + window_size - 1
+
+        windowed_pass_fluxes[team_name][block_index] = {
+            "flux": flux,
+            "channel": channel_frames[i],
+            "third": third_frames[i],
+            "zone": zone_table.iloc[9 * i:9 * (i + 1)].set_axis(zone_index),
             "window": (start_minute, end_minute)
         }
 
@@ -94,13 +370,12 @@ def compute_windowed_metrics(df, window_size=15, grid_size=8):
 
 def df_with_channel_and_third(df):
     '''Function to add channel and third columns to DataFrame.'''
-    df_with_channel_and_third = df.copy()
-    df_with_channel_and_third["channel"] = df_with_channel_and_third["location_x"].apply(assign_channel)
-    df_with_channel_and_third["third"] = df_with_channel_and_third["location_y"].apply(assign_third)
-    return df_with_channel_and_third
+    zones = classify_zones(df)
+    return df.assign(channel=CHANNEL_LABELS[zones["channel"].to_numpy()], third=THIRD_LABELS[zones["third"].to_numpy()])
 
+@stage()
 def heatmap_minute(df, grid_size=8):
     '''Function to compute heatmap by minute with channel and third.'''
-    df_with_channel_and_third = df_with_channel_and_third(df)
-    heatmap_by_minute = df_with_channel_and_third.groupby(['team_name', 'minute', 'channel', 'third']).size().unstack(fill_value=0)
+    df_zones = df_with_channel_and_third(df[["team_name", "minute", "location_x", "location_y"]])
+    heatmap_by_minute = df_zones.groupby(['team_name', 'minute', 'channel', 'third'], observed=True).size().unstack(fill_value=0)
     return heatmap_by_minute
\ No newline at end of file
@@ -1,11 +1,29 @@
 from statsbombpy import sb
+from itertools import chain
+from loader import load_events_offline
+from instrument import stage
 import pandas as pd 
 import numpy as np
+from pandas.api.types import union_categoricals
 
-def load_events(match_id):
-    events_df = sb.events(match_id=match_id)
-    return events_df
+TACTICAL_EVENT_TYPES = ["Starting XI", "Substitution", "Tactical Shift"]
+COORDINATE_COLUMNS = {
+    'location': ['location_x', 'location_y'],
+    'pass_end_location': ['pass_end_location_x', 'pass_end_location_y'],
+    'carry_end_location': ['carry_end_location_x', 'carry_end_location_y'],
+    'goalkeeper_end_location': ['goalkeeper_end_location_x', 'goalkeeper_end_location_y'],
+    'shot_end_location': ['shot_end_location_x', 'shot_end_location_y', 'shot_end_location_z'],
+}
 
+@stage()
+def load_events(match_id, data_dir=None, cache_dir=None, columns=None):
+    '''Function to load a match's events from the StatsBomb API, or from local open-data files and the event cache when data_dir or cache_dir is given.'''
+    if data_dir is None and cache_dir is None:
+        events_df = sb.events(match_id=match_id)
+        return events_df
+    return load_events_offline(match_id, data_dir, cache_dir=cache_dir, columns=columns)
+
+@stage()
 def parse_events(events_df):
     '''Function to parse events from JSON data into a DataFrame.'''
     df = events_df.copy()
@@ -54,9 +72,115 @@ def parse_events(events_df):
 
     return df
 
+def _unpack_list_column(values, width):
+    '''Function to unpack a column of coordinate lists into a NaN-padded float array of shape (n, width).'''
+    lists = [v if isinstance(v, (list, tuple, np.ndarray)) else () for v in values]
+    lengths = np.fromiter(map(len, lists), dtype=np.intp, count=len(lists))
+    coords = np.full((len(lists), width), np.nan)
+    total = int(lengths.sum())
+    if total:
+        flat = np.fromiter(chain.from_iterable(lists), dtype=float, count=total)
+        rows = np.repeat(np.arange(len(lists)), lengths)
+        cols = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        keep = cols < width
+        coords[rows[keep], cols[keep]] = flat[keep]
+    return coords
+
+@stage()
+def parse_events_columnar(events_df, compact=False):
+    '''Function to parse events like parse_events, unpacking every coordinate column in one pass and copying the frame once.
+
+    The raw list columns are left as they are instead of having missing values replaced by [nan, nan];
+    compact=True passes the result through compact_events.'''
+    new_columns = {}
+    if "player" in events_df.columns:
+        new_columns['player_name'] = events_df['player']
+
+    if 'team' in events_df.columns:
+        new_columns['team_name'] = events_df['team']
+
+    if 'position' in events_df.columns:
+        positions = events_df['position']
+        new_columns['position_id'] = pd.Series([p.get('id') if isinstance(p, dict) else np.nan for p in positions], index=events_df.index)
+        new_columns['position_name'] = pd.Series([p.get('name') if isinstance(p, dict) else np.nan for p in positions], index=events_df.index)
+
+    for column, names in COORDINATE_COLUMNS.items():
+        if column in events_df.columns:
+            coords = _unpack_list_column(events_df[column], len(names))
+            for i, name in enumerate(names):
+                new_columns[name] = coords[:, i]
+
+    df = events_df.drop(columns=[c for c in new_columns if c in events_df.columns])
+    df = pd.concat([df, pd.DataFrame(new_columns, index=df.index)], axis=1)
+
+    if 'type' in df.columns and 'type.name' not in df.columns:
+        df.rename(columns={'type': 'type.name'}, inplace=True)
+
+    return compact_events(df) if compact else df
+
+CATEGORICAL_COLUMNS = ["team", "team_name", "player", "player_name", "type.name", "position", "position_name", "possession_team", "play_pattern"]
+SMALL_INT_COLUMNS = {"period": np.int8, "minute": np.int16, "second": np.int8}
+
+def _first_value(series):
+    index = series.first_valid_index()
+    return None if index is None else series.at[index]
+
+def compact_events(df, keep=("tactics",), archive=False):
+    '''Function to shrink a parsed event frame: drop nested list/dict columns, downcast coordinates and label columns.
+
+    Coordinates become float32 (StatsBomb gives them to 0.1 yards), team, player, type, position and other
+    repetitive string columns become categoricals and period/minute/second small integers. Columns in
+    keep stay as they are, so extract_tactics still finds its tactics dicts. With archive=True the dropped
+    columns are also returned, restricted to the rows that had a value, as (compact_df, archived_df).'''
+    nested, dtypes = [], {}
+    coordinates = {name for names in COORDINATE_COLUMNS.values() for name in names}
+    for column in df.columns:
+        series = df[column]
+        if column in keep:
+            continue
+        if column in coordinates and pd.api.types.is_float_dtype(series.dtype):
+            dtypes[column] = np.float32
+        elif column in SMALL_INT_COLUMNS and pd.api.types.is_integer_dtype(series.dtype):
+            dtypes[column] = SMALL_INT_COLUMNS[column]
+        elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+            value = _first_value(series)
+            if isinstance(value, (list, tuple, dict, np.ndarray)):
+                nested.append(column)
+            elif column in CATEGORICAL_COLUMNS or (isinstance(value, str) and column != "id" and series.nunique() * 2 <= series.count()):
+                dtypes[column] = "category"
+
+    compact_df = df.drop(columns=nested).astype(dtypes)
+    if not archive:
+        return compact_df
+    archived_df = df.loc[df[nested].notna().any(axis=1), nested] if nested else df.iloc[:, :0]
+    return compact_df, archived_df
+
+def concat_events(frames):
+    '''Function to concatenate compact match frames, merging categories so categorical columns stay categorical.'''
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+    categorical = [c for c in frames[0].columns if isinstance(frames[0][c].dtype, pd.CategoricalDtype)
+                   and all(c in f.columns and isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames)]
+    categories = {c: union_categoricals([f[c] for f in frames], sort_categories=True).categories for c in categorical}
+    frames = [f.assign(**{c: f[c].cat.set_categories(cats) for c, cats in categories.items()}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def load_parsed_matches(match_ids, data_dir=None, cache_dir=None, compact=True):
+    '''Function to load and parse many matches into one frame, compacting each match before the next is loaded.'''
+    frames = []
+    for match_id in match_ids:
+        df = parse_events_columnar(load_events(match_id, data_dir=data_dir, cache_dir=cache_dir), compact=compact)
+        if "match_id" not in df.columns:
+            df.insert(0, "match_id", match_id)
+        frames.append(df)
+    return concat_events(frames) if compact else pd.concat(frames, ignore_index=True)
+
+@stage()
 def extract_tactics(df):
     '''Function to extract tactics-related events from the DataFrame.'''
-    tactical_events = df[df['type.name'].isin(["Starting XI", "Substitution", "Tactical Shift"])].copy()
+    tactical_events = df[df['type.name'].isin(TACTICAL_EVENT_TYPES)]
+    tactical_events = tactical_events.sort_values([c for c in ["period", "minute", "second", "index"] if c in df.columns], kind="stable")
     team_states = []
     current_lineups = {}
     for _, event in tactical_events.iterrows():
@@ -81,7 +205,7 @@ def extract_tactics(df):
                     "second": event['second'], 
                     'event_type': "Starting XI", 
                     "formation": event["tactics"].get('formation'), 
-                    "lineup": current_lineups[team_id]["players"],
+                    "lineup": current_lineups[team_id]["players"].copy(),
                     'substituted_in': None, 
                     'substituted_out': None
 
@@ -114,7 +238,7 @@ def extract_tactics(df):
                     'second': event['second'],
                     'event_type': "Substitution",
                     "formation": current_lineups[team_id]["formation"],
-                    "lineup": current_lineups[team_id]["players"],
+                    "lineup": current_lineups[team_id]["players"].copy(),
                     "substituted_in": incoming_player_name,
                     "substituted_out": sub_player_id
                 })  
@@ -145,15 +269,11 @@ def extract_tactics(df):
                 'substituted_out': None
             })
 
-    df_lineups = pd.DataFrame(team_states)
-    if not df_lineups.empty:
-        df_lineups = df_lineups.explode('lineup').reset_index(drop=True)
-        player_data = df_lineups['lineup'].apply(pd.Series)
-        df_tactics_final = pd.concat([df_lineups.drop(columns=['lineup']), player_data], axis=1)
-
-    else:
-        df_tactics_final = pd.DataFrame()
+    df_tactics_final = pd.DataFrame([
+        {**{k: v for k, v in state.items() if k != 'lineup'}, **player}
+        for state in team_states for player in state['lineup']
+    ])
 
-    df_main_final = df[~df["type.name"].isin(["Starting XI", "Substitution", "Tactical Shift"])].copy()
+    df_main_final = df[~df["type.name"].isin(TACTICAL_EVENT_TYPES)]
 
     return df_tactics_final, df_main_final
@@ -0,0 +1,213 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import pandas as pd
+from pathlib import Path
+from parser import load_events, parse_events_columnar, extract_tactics
+from metrics import compute_windowed_metrics_fused
+from loader import _source_stamp, read_event_cache_meta
+from utils import save_match_metrics
+from batch import team_ids
+
+STAGES = ["events", "parsed", "tactics", "windowed", "saved"]
+STAGE_VERSIONS = {"events": 1, "parsed": 1, "tactics": 1, "windowed": 1, "saved": 1}
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+class StageCache:
+    '''On-disk store of pipeline stage results, content-addressed by stage, stage version, upstream key and parameters.
+
+    Entries live in cache_dir/<stage>/<match_id>_<key>.pkl. Reading an entry refreshes its mtime and
+    the least recently used entries are evicted once the cache grows past max_bytes.'''
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def key(self, stage, upstream_key, params):
+        '''Function to hash a stage, its version, the key of its input and its parameters into a cache key.'''
+        payload = json.dumps([stage, STAGE_VERSIONS[stage], upstream_key, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, stage, match_id, key):
+        return self.cache_dir / stage / f"{match_id}_{key}.pkl"
+
+    def get(self, stage, match_id, key):
+        '''Function to return (True, value) for a cached entry and (False, None) on a miss.'''
+        path = self._path(stage, match_id, key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except (pickle.UnpicklingError, EOFError):
+            path.unlink(missing_ok=True)
+            return False, None
+        os.utime(path)
+        return True, value
+
+    def put(self, stage, match_id, key, value):
+        '''Function to store a stage result and evict old entries if the cache is over its size bound.'''
+        path = self._path(stage, match_id, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def entries(self):
+        '''Function to list cached entries as (path, size, mtime), least recently used first.'''
+        if not self.cache_dir.exists():
+            return []
+        entries = []
+        for path in self.cache_dir.glob("*/*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime_ns))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''Function to delete least recently used entries until the cache fits in max_bytes.'''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def invalidate(self, match_id=None, stage=None):
+        '''Function to delete the entries of one match and/or one stage together with every stage downstream of it.
+
+        With no arguments the whole cache is cleared.'''
+        stages = STAGES if stage is None else STAGES[STAGES.index(stage):]
+        pattern = "*.pkl" if match_id is None else f"{match_id}_*.pkl"
+        removed = 0
+        for name in stages:
+            for path in (self.cache_dir / name).glob(pattern):
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+def _source_key(match_id, data_dir=None, cache_dir=None):
+    '''Function to identify a match's raw events: the open-data file's size and mtime when it is local.
+
+    Matches fetched from the StatsBomb API have no stamp; run_pipeline keys them by _content_key instead.'''
+    source = None
+    source_path = Path(data_dir) / "events" / f"{match_id}.json" if data_dir is not None else None
+    if source_path is not None and source_path.exists():
+        source = _source_stamp(source_path)
+    elif cache_dir is not None:
+        meta = read_event_cache_meta(match_id, cache_dir)
+        source = meta.get("source") if meta else None
+    return {"match_id": int(match_id), "source": source}
+
+def _hashable(value):
+    '''Function to turn one event value into a string, with nested dicts and lists as sorted JSON.'''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return str(value)
+
+def _content_key(events_df):
+    '''Function to hash a loaded events frame (column names, row order and every value) for sources without a file stamp.'''
+    columns = {name: events_df[name].map(_hashable) if events_df[name].dtype == object else events_df[name] for name in events_df.columns}
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(columns, index=events_df.index), index=False)
+    digest = hashlib.sha256(json.dumps([str(name) for name in events_df.columns]).encode())
+    digest.update(hashes.to_numpy().tobytes())
+    return digest.hexdigest()
+
+def run_pipeline(match_id, stage_cache, data_dir=None, cache_dir=None, window_size=15, grid_size=8, output_dir=None):
+    '''Function to run load -> parse -> tactics -> windowed metrics -> save for one match, reusing cached stages.
+
+    Each stage key chains the key of the stage before it, so changing window_size or grid_size only
+    recomputes the windowed and save stages, and a stage is only loaded from disk when a later stage
+    misses. Events without a local file stamp (StatsBomb API matches) are loaded up front and keyed by
+    a hash of their content, so changed upstream data is picked up. Returns the windowed metrics, team
+    ids and the stages that had to be recomputed.'''
+    values, computed = {}, []
+    events_key = _source_key(match_id, data_dir, cache_dir)
+    if events_key["source"] is None:
+        values["events"] = load_events(match_id, data_dir=data_dir, cache_dir=cache_dir)
+        events_key["content"] = _content_key(values["events"])
+        computed.append("events")
+    params = {
+        "events": events_key,
+        "parsed": {},
+        "tactics": {},
+        "windowed": {"window_size": window_size, "grid_size": grid_size},
+        "saved": {"output_dir": str(Path(output_dir).resolve()) if output_dir is not None else None},
+    }
+    keys = {}
+    upstream_key = None
+    for stage in STAGES:
+        keys[stage] = upstream_key = stage_cache.key(stage, upstream_key, params[stage])
+
+    def save(windowed):
+        save_match_metrics(windowed["windowed_metrics"], match_id, windowed["team_infor"], output_dir)
+        json_filepath = Path(output_dir) / "metrics" / f"{match_id}_metrics.json"
+        return {"path": str(json_filepath), "stamp": _source_stamp(json_filepath)}
+
+    def saved_output_current(saved):
+        path = Path(saved["path"])
+        return path.exists() and _source_stamp(path) == saved["stamp"]
+
+    steps = {
+        "events": lambda _: load_events(match_id, data_dir=data_dir, cache_dir=cache_dir),
+        "parsed": parse_events_columnar,
+        "tactics": extract_tactics,
+        "windowed": lambda tactics: {
+            "windowed_metrics": compute_windowed_metrics_fused(tactics[1], window_size=window_size, grid_size=grid_size),
+            "team_infor": team_ids(tactics[1]),
+        },
+        "saved": save,
+    }
+
+    def resolve(i):
+        stage = STAGES[i]
+        if stage in values:
+            return values[stage]
+        hit, value = stage_cache.get(stage, match_id, keys[stage])
+        if not hit or (stage == "saved" and not saved_output_current(value)):
+            value = steps[stage](resolve(i - 1) if i else None)
+            stage_cache.put(stage, match_id, keys[stage], value)
+            computed.append(stage)
+        values[stage] = value
+        return value
+
+    windowed = resolve(STAGES.index("windowed"))
+    if output_dir is not None:
+        resolve(STAGES.index("saved"))
+    return {**windowed, "computed": computed, "keys": keys}
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Sweep window and grid sizes over matches, reusing cached pipeline stages.")
+    arg_parser.add_argument("--match-ids", type=int, nargs="+", required=True)
+    arg_parser.add_argument("--window-sizes", type=int, nargs="+", default=[15])
+    arg_parser.add_argument("--grid-sizes", type=int, nargs="+", default=[8])
+    arg_parser.add_argument("--output-dir", default=None, help="also save metrics; each sweep point overwrites the match's files")
+    arg_parser.add_argument("--stage-cache-dir", default=os.environ.get("STAGE_CACHE_DIR", ".stage_cache"))
+    arg_parser.add_argument("--max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3)
+    arg_parser.add_argument("--data-dir", default=os.environ.get("STATSBOMB_DATA_DIR"))
+    arg_parser.add_argument("--cache-dir", default=os.environ.get("EVENT_CACHE_DIR"))
+    arg_parser.add_argument("--invalidate", choices=STAGES, default=None, help="drop this stage and everything after it first")
+    args = arg_parser.parse_args()
+
+    stage_cache = StageCache(args.stage_cache_dir, max_bytes=int(args.max_gb * 1024 ** 3))
+    for match_id in args.match_ids:
+        if args.invalidate is not None:
+            stage_cache.invalidate(match_id=match_id, stage=args.invalidate)
+        for window_size in args.window_sizes:
+            for grid_size in args.grid_sizes:
+                result = run_pipeline(match_id, stage_cache, args.data_dir, args.cache_dir, window_size, grid_size, args.output_dir)
+                print(f"match {match_id} window {window_size} grid {grid_size}: recomputed {result['computed'] or 'nothing'}")
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+from instrument import stage
+from metrics import _factorize_keys, _pitch_cells, PITCH_LENGTH, PITCH_WIDTH, SCHEMA_CHANNEL_LABELS, THIRD_LABELS
+
+CHAIN_COLUMNS = ["match_id", "chain_id", "possession", "possession_team", "period", "start_minute", "start_second",
+                 "end_minute", "end_second", "duration", "n_events", "n_passes", "start_x", "start_y", "end_x", "end_y",
+                 "territory_gained", "start_pitch_zone", "end_pitch_zone", "start_pitch_channel", "start_pitch_third",
+                 "end_pitch_channel", "end_pitch_third"]
+
+def _column(df, name, dtype=float):
+    '''Function to read a column as a numpy array, all NaN when the frame does not have it.'''
+    if name not in df.columns:
+        return np.full(len(df), np.nan)
+    return df[name].to_numpy(dtype=dtype, na_value=np.nan)
+
+def _reach(df, axis):
+    '''Function to take the furthest point an event moved the ball to: its pass or carry end, else its own location.'''
+    reach = _column(df, f"pass_end_location_{axis}")
+    for name in (f"carry_end_location_{axis}", f"location_{axis}"):
+        reach = np.where(np.isnan(reach), _column(df, name), reach)
+    return reach
+
+def _pitch_bands(values, extent):
+    '''Function to map coordinates on a 0..extent pitch axis to 0/1/2 band codes of equal width.'''
+    return np.clip(np.floor(np.nan_to_num(values) * 3 / extent), 0, 2).astype(np.int8)
+
+def _zone_labels(channel, third, located):
+    '''Function to turn channel and third codes into zone codes (-1 when unlocated) and labelled categoricals.'''
+    channel = np.where(located, channel, -1).astype(np.int8)
+    third = np.where(located, third, -1).astype(np.int8)
+    zone = np.where(located, channel * 3 + third, -1).astype(np.int8)
+    return zone, pd.Categorical.from_codes(channel, SCHEMA_CHANNEL_LABELS), pd.Categorical.from_codes(third, THIRD_LABELS)
+
+@stage()
+def possession_chains(df, grid_size=8, match_id=None):
+    '''Function to split parsed matches into possession chains and describe every chain at once.
+
+    A chain starts wherever the match, the possession id or the period changes in event order, so a
+    whole season frame with a match_id column gives the same chains as its matches one by one; the
+    match_id column of the result comes from the frame, or from match_id when the frame has none.
+
+    Start and end points use only the possession team's own events (StatsBomb coordinates are
+    relative to the team on the ball): the first located event, and the pass or carry end of the last
+    one. Like compute_density_tensor, chains use the 120 x 80 pitch: territory gained and the pitch
+    thirds are measured along x, the attacking direction, and the pitch channels along y (left,
+    centre, right from y = 0). These pitch_* zones are not the 0-100 zones of classify_zones and
+    zone_usage, hence their own column names. Returns (chains, flux): one row per chain and a CSR
+    matrix with the chain's own passes in row chain_id, lane from_cell -> to_cell in column
+    from_cell * n_cells + to_cell, on a grid_size x grid_size grid over the same 120 x 80 pitch.'''
+    n_cells = grid_size * grid_size
+    sort_columns = [c for c in ["match_id", "period", "minute", "second", "index"] if c in df.columns]
+    order = np.lexsort([df[c].to_numpy() for c in reversed(sort_columns)]) if sort_columns else np.arange(len(df))
+    events = df.iloc[order]
+    n = len(events)
+    if not n:
+        return pd.DataFrame(columns=CHAIN_COLUMNS), csr_matrix((0, n_cells * n_cells), dtype=np.int64)
+
+    possession = events["possession"].to_numpy()
+    period = events["period"].to_numpy() if "period" in events.columns else np.ones(n, dtype=np.int8)
+    matches = events["match_id"].to_numpy() if "match_id" in events.columns else np.full(n, match_id, dtype=object)
+    boundary = np.r_[True, (possession[1:] != possession[:-1]) | (period[1:] != period[:-1]) | (matches[1:] != matches[:-1])]
+    starts = np.flatnonzero(boundary)
+    chain_ids = np.cumsum(boundary) - 1
+    n_events = np.diff(np.r_[starts, n])
+
+    possession_team = np.asarray(events["possession_team"], dtype=object)
+    own = possession_team == np.asarray(events["team_name"], dtype=object)
+    is_pass = own & (events["type.name"] == "Pass").to_numpy()
+    minutes = events["minute"].to_numpy().astype(np.int64)
+    seconds = events["second"].to_numpy().astype(np.int64)
+    clock = minutes * 60 + seconds
+    last = np.r_[starts[1:], n] - 1
+
+    xs, ys = _column(events, "location_x"), _column(events, "location_y")
+    located = own & ~np.isnan(xs) & ~np.isnan(ys)
+    positions = np.arange(n)
+    first_located = np.minimum.reduceat(np.where(located, positions, n), starts)
+    last_located = np.maximum.reduceat(np.where(located, positions, -1), starts)
+    has_start = first_located < n
+    first_located = np.where(has_start, first_located, 0)
+    last_located = np.where(has_start, last_located, 0)
+    reach_x, reach_y = _reach(events, "x"), _reach(events, "y")
+    start_x = np.where(has_start, xs[first_located], np.nan)
+    start_y = np.where(has_start, ys[first_located], np.nan)
+    end_x = np.where(has_start, reach_x[last_located], np.nan)
+    end_y = np.where(has_start, reach_y[last_located], np.nan)
+
+    start_pitch_zone, start_pitch_channel, start_pitch_third = _zone_labels(_pitch_bands(start_y, PITCH_WIDTH), _pitch_bands(start_x, PITCH_LENGTH), has_start)
+    end_pitch_zone, end_pitch_channel, end_pitch_third = _zone_labels(_pitch_bands(end_y, PITCH_WIDTH), _pitch_bands(end_x, PITCH_LENGTH), has_start)
+    chains = pd.DataFrame({
+        "match_id": matches[starts],
+        "chain_id": np.arange(len(starts)),
+        "possession": possession[starts],
+        "possession_team": possession_team[starts],
+        "period": period[starts],
+        "start_minute": minutes[starts],
+        "start_second": seconds[starts],
+        "end_minute": minutes[last],
+        "end_second": seconds[last],
+        "duration": np.maximum.reduceat(clock, starts) - clock[starts],
+        "n_events": n_events,
+        "n_passes": np.add.reduceat(is_pass.astype(np.int64), starts),
+        "start_x": start_x,
+        "start_y": start_y,
+        "end_x": end_x,
+        "end_y": end_y,
+        "territory_gained": end_x - start_x,
+        "start_pitch_zone": start_pitch_zone,
+        "end_pitch_zone": end_pitch_zone,
+        "start_pitch_channel": start_pitch_channel,
+        "start_pitch_third": start_pitch_third,
+        "end_pitch_channel": end_pitch_channel,
+        "end_pitch_third": end_pitch_third,
+    })
+
+    pass_end_x, pass_end_y = _column(events, "pass_end_location_x"), _column(events, "pass_end_location_y")
+    passes = is_pass & ~np.isnan(xs) & ~np.isnan(ys) & ~np.isnan(pass_end_x) & ~np.isnan(pass_end_y)
+    starts_flat, starts_inside = _pitch_cells(xs[passes], ys[passes], (grid_size, grid_size))
+    ends_flat, ends_inside = _pitch_cells(pass_end_x[passes], pass_end_y[passes], (grid_size, grid_size))
+    inside = starts_inside & ends_inside
+    rows = chain_ids[passes][inside]
+    lanes = starts_flat[inside] * n_cells + ends_flat[inside]
+    data = np.ones(len(rows), dtype=np.int64)
+    flux = coo_matrix((data, (rows, lanes)), shape=(len(starts), n_cells * n_cells)).tocsr()
+    return chains, flux
+
+def chain_flux(chains, flux, mask=None, by="possession_team", grid_size=8):
+    '''Function to add up the pass flux of the selected chains per value of the by column.
+
+    mask is a boolean Series or array over chains (e.g. chains["end_pitch_third"] == "final"); every chain
+    is used when it is None. Returns {key: (n_cells, n_cells) CSR matrix} laid out like the windowed flux, but with
+    cells on the 120 x 80 pitch grid of possession_chains.'''
+    n_cells = grid_size * grid_size
+    key_codes, keys = _factorize_keys(chains[by])
+    selected = key_codes >= 0
+    if mask is not None:
+        selected &= np.asarray(mask, dtype=bool)
+    indicator = csr_matrix((np.ones(int(selected.sum()), dtype=np.int64), (key_codes[selected], np.flatnonzero(selected))), shape=(len(keys), len(chains)))
+    totals = (indicator @ flux).tocsr()
+    return {key: totals[i].reshape(n_cells, n_cells).tocsr() for i, key in enumerate(keys)}
+
+def chain_summary(chains, mask=None, by="possession_team"):
+    '''Function to aggregate the selected chains per value of the by column (a column name or list of them).
+
+    Returns chain counts, mean length, duration and territory gained, total passes and the share of
+    chains ending in the final pitch third.'''
+    selected = chains if mask is None else chains[np.asarray(mask, dtype=bool)]
+    return selected.assign(ends_final_third=selected["end_pitch_third"] == "final").groupby(by, observed=True).agg(
+        chains=("chain_id", "size"),
+        mean_events=("n_events", "mean"),
+        mean_passes=("n_passes", "mean"),
+        total_passes=("n_passes", "sum"),
+        mean_duration=("duration", "mean"),
+        mean_territory_gained=("territory_gained", "mean"),
+        final_third_share=("ends_final_third", "mean"),
+    )
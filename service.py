@@ -0,0 +1,190 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from fastapi import FastAPI, HTTPException, Query
+from parser import load_events, parse_events_columnar, extract_tactics
+from metrics import compute_heatmap_tensor, compute_windowed_metrics_fused, _compute_zone_usage
+from utils import stack_flux_windows, summarize_flux_windows
+
+class ResultCache:
+    '''Bounded LRU cache with a time-to-live whose concurrent misses on one key share a single computation.'''
+
+    def __init__(self, maxsize=256, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    async def get_or_compute(self, key, compute):
+        '''Function to return the cached value for key, or await compute() once for all concurrent callers.'''
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._compute(key, compute))
+        return await asyncio.shield(task)
+
+    async def _compute(self, key, compute):
+        try:
+            value = await compute()
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return value
+        finally:
+            del self._inflight[key]
+
+@lru_cache(maxsize=8)
+def _match_events(match_id, data_dir, cache_dir):
+    '''Function to load and parse a match once per worker process.'''
+    events_df = parse_events_columnar(load_events(match_id, data_dir=data_dir, cache_dir=cache_dir), compact=True)
+    tactics_df, main_df = extract_tactics(events_df)
+    return main_df
+
+def _filter_team(df, team):
+    return df if team is None else df[df["team_name"] == team]
+
+def heatmap_job(match_id, data_dir, cache_dir, team, grid_size, event_type=None):
+    '''Function to compute team heatmaps in a worker process.'''
+    df = _filter_team(_match_events(match_id, data_dir, cache_dir), team)
+    if event_type is not None:
+        df = df[df["type.name"] == event_type]
+    heatmaps, teams = compute_heatmap_tensor(df, by="team_name", grid_size=grid_size)
+    edges = np.linspace(0, 100, grid_size + 1).tolist()
+    return {
+        "match_id": match_id,
+        "metrics": [{
+            "metric_type": "team_heatmap",
+            "team_name": team_name,
+            "event_type": event_type or "all",
+            "grid_size": grid_size,
+            "heatmap": heat.tolist(),
+            "x_edges": edges,
+            "y_edges": edges,
+        } for team_name, heat in zip(teams, heatmaps)],
+    }
+
+def zone_usage_job(match_id, data_dir, cache_dir, team, event_type=None):
+    '''Function to compute channel-by-third zone usage in a worker process.'''
+    df = _filter_team(_match_events(match_id, data_dir, cache_dir), team)
+    if event_type is not None:
+        df = df[df["type.name"] == event_type]
+    zones = _compute_zone_usage(df)
+    minutes = df["minute"]
+    time_window = {"start_minute": int(minutes.min()), "end_minute": int(minutes.max())} if len(minutes) else None
+    return {
+        "match_id": match_id,
+        "metrics": [{
+            "metric_type": "zone_usage",
+            "team_name": team_name,
+            "event_type": event_type or "all",
+            "time_window": time_window,
+            "zone_counts": group[["vertical_channel", "horizontal_third", "count"]].to_dict("records"),
+        } for team_name, group in zones.groupby("team_name", sort=True)],
+    }
+
+def _windows(match_id, data_dir, cache_dir, window_size, grid_size, team):
+    windowed = compute_windowed_metrics_fused(_match_events(match_id, data_dir, cache_dir), window_size=window_size, grid_size=grid_size)
+    for team_name, blocks in windowed.items():
+        if team is None or team_name == team:
+            for metrics_data in blocks.values():
+                window = metrics_data["window"]
+                yield team_name, {"start_minute": int(window[0]), "end_minute": int(window[1])}, metrics_data
+
+def flux_job(match_id, data_dir, cache_dir, team, window_size, grid_size):
+    '''Function to compute windowed pass flux lists in a worker process.'''
+    metrics = []
+    for team_name, time_window, metrics_data in _windows(match_id, data_dir, cache_dir, window_size, grid_size, team):
+        flux = metrics_data["flux"].tocoo()
+        metrics.append({
+            "metric_type": "pass_flux_window_matrix",
+            "team_name": team_name,
+            "time_window": time_window,
+            "grid_size": grid_size,
+            "flux_list": [{"from_cell": int(r), "to_cell": int(c), "count": int(v)} for r, c, v in zip(flux.row, flux.col, flux.data)],
+            "cell_indexing": "row_major:(row*grid_size + col)",
+        })
+    return {"match_id": match_id, "metrics": metrics}
+
+def flux_summary_job(match_id, data_dir, cache_dir, team, window_size, grid_size, top_n=3):
+    '''Function to summarise windowed pass fluxes in a worker process.'''
+    windowed = compute_windowed_metrics_fused(_match_events(match_id, data_dir, cache_dir), window_size=window_size, grid_size=grid_size)
+    windows, flux = stack_flux_windows(windowed, match_id)
+    summary = summarize_flux_windows(windows, flux, top_n_lanes=top_n)
+    if team is not None:
+        summary = summary[summary["team_name"] == team]
+    metrics = []
+    for (team_name, block_index), lanes in summary.groupby(["team_name", "block_index"], sort=False):
+        first = lanes.iloc[0]
+        metrics.append({
+            "team_name": team_name,
+            "time_window": {"start_minute": int(first["start_minute"]), "end_minute": int(first["end_minute"])},
+            "total_passes": int(first["total_passes"]),
+            "top_lanes": [{"from_cell": int(f), "to_cell": int(t), "count": int(c)}
+                          for f, t, c in zip(lanes["from_cell"], lanes["to_cell"], lanes["count"]) if pd.notna(c)],
+        })
+    return {"match_id": match_id, "metrics": metrics}
+
+def create_app(data_dir=None, cache_dir=None, workers=None, cache_size=256, cache_ttl=600):
+    '''Function to build the metrics service; heavy work runs in a process pool and results go through a ResultCache.'''
+    cache = ResultCache(maxsize=cache_size, ttl=cache_ttl)
+    state = {}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        state["pool"] = ProcessPoolExecutor(max_workers=workers)
+        yield
+        state["pool"].shutdown(cancel_futures=True)
+
+    app = FastAPI(title="Tactical Heatmap Narrator metrics", lifespan=lifespan)
+
+    async def run(job, match_id, team, *params):
+        key = (job.__name__, match_id, team) + params
+
+        async def compute():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(state["pool"], job, match_id, data_dir, cache_dir, team, *params)
+
+        try:
+            result = await cache.get_or_compute(key, compute)
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        if team is not None and not result["metrics"]:
+            raise HTTPException(status_code=404, detail=f"No metrics for team {team!r} in match {match_id}")
+        return result
+
+    @app.get("/matches/{match_id}/heatmap")
+    async def heatmap(match_id: int, grid_size: int = Query(8, ge=1, le=100), team: str | None = None, event_type: str | None = None):
+        return await run(heatmap_job, match_id, team, grid_size, event_type)
+
+    @app.get("/matches/{match_id}/zone-usage")
+    async def zone_usage(match_id: int, team: str | None = None, event_type: str | None = None):
+        return await run(zone_usage_job, match_id, team, event_type)
+
+    @app.get("/matches/{match_id}/flux")
+    async def flux(match_id: int, window_size: int = Query(15, ge=1), grid_size: int = Query(8, ge=1, le=32), team: str | None = None):
+        return await run(flux_job, match_id, team, window_size, grid_size)
+
+    @app.get("/matches/{match_id}/flux-summary")
+    async def flux_summary(match_id: int, window_size: int = Query(15, ge=1), grid_size: int = Query(8, ge=1, le=32),
+                           team: str | None = None, top_n: int = Query(3, ge=1)):
+        return await run(flux_summary_job, match_id, team, window_size, grid_size, top_n)
+
+    return app
+
+app = create_app(
+    data_dir=os.environ.get("STATSBOMB_DATA_DIR"),
+    cache_dir=os.environ.get("EVENT_CACHE_DIR"),
+    workers=int(os.environ["SERVICE_WORKERS"]) if os.environ.get("SERVICE_WORKERS") else None,
+    cache_size=int(os.environ.get("SERVICE_CACHE_SIZE", 256)),
+    cache_ttl=float(os.environ.get("SERVICE_CACHE_TTL", 600)),
+)
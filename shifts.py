@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from scipy.ndimage import maximum_filter1d
+from timecube import TimeCube
+
+SHIFT_COLUMNS = ["team_name", "minute", "before_start", "before_end", "after_start", "after_end",
+                 "heat_distance", "flux_distance", "distance", "z_score", "n_before", "n_after"]
+
+def _cosine_distance(before, after):
+    '''Function to compute 1 - cosine similarity along the last axis, NaN where either side is empty.'''
+    before = before.astype(np.float64)
+    after = after.astype(np.float64)
+    norms = np.linalg.norm(before, axis=-1) * np.linalg.norm(after, axis=-1)
+    dots = np.einsum("...i,...i->...", before, after)
+    return np.where(norms > 0, 1 - dots / np.where(norms > 0, norms, 1), np.nan)
+
+def _pool_lanes(flux, grid_size, pool):
+    '''Function to sum (..., g**4) flux lanes into (..., (g/pool)**4) lanes between pool x pool blocks of cells.'''
+    pool = pool if grid_size % pool == 0 else 1
+    c = grid_size // pool
+    shape = flux.shape[:-1]
+    flux = flux.reshape(*shape, c, pool, c, pool, c, pool, c, pool)
+    return flux.sum(axis=tuple(len(shape) + i for i in (1, 3, 5, 7))).reshape(*shape, -1)
+
+def window_distances(cube, window_size=5, step=1, heat_weight=0.5, min_events=10, pool=2):
+    '''Function to compare the window_size minutes before and after every boundary minute of every team.
+
+    Boundaries run every step minutes (step=1 slides minute by minute, step=window_size compares
+    consecutive windows). Both windows come from the cube's prefix sums, so all teams and boundaries
+    are computed in one pass. Flux lanes are pooled between pool x pool blocks of cells, since a few
+    minutes of passes rarely reuse the exact same cell-to-cell lane. Returns one row per team and
+    boundary with heat, flux and combined cosine distances; boundaries where either window has fewer
+    than min_events events get NaN, and boundaries without passes on one side fall back to heat alone.'''
+    boundaries = np.arange(window_size, cube.n_minutes - window_size + 1, step)
+    if not len(boundaries) or not cube.teams:
+        return pd.DataFrame(columns=[c for c in SHIFT_COLUMNS if c != "z_score"])
+
+    def windows(cumulative):
+        return cumulative[:, boundaries] - cumulative[:, boundaries - window_size], cumulative[:, boundaries + window_size] - cumulative[:, boundaries]
+
+    heat_before, heat_after = windows(cube.heat_cum)
+    flux_before, flux_after = (_pool_lanes(flux, cube.grid_size, pool) for flux in windows(cube.flux_cum))
+    heat_distance = _cosine_distance(heat_before, heat_after)
+    flux_distance = _cosine_distance(flux_before, flux_after)
+    n_before, n_after = heat_before.sum(axis=-1), heat_after.sum(axis=-1)
+    distance = np.where(np.isnan(flux_distance), heat_distance, heat_weight * heat_distance + (1 - heat_weight) * flux_distance)
+    distance[(n_before < min_events) | (n_after < min_events) | np.isnan(heat_distance)] = np.nan
+
+    n_teams = len(cube.teams)
+    minutes = np.tile(boundaries, n_teams)
+    return pd.DataFrame({
+        "team_name": np.repeat(np.array(cube.teams, dtype=object), len(boundaries)),
+        "minute": minutes,
+        "before_start": minutes - window_size,
+        "before_end": minutes - 1,
+        "after_start": minutes,
+        "after_end": minutes + window_size - 1,
+        "heat_distance": heat_distance.ravel(),
+        "flux_distance": flux_distance.ravel(),
+        "distance": distance.ravel(),
+        "n_before": n_before.ravel(),
+        "n_after": n_after.ravel(),
+    })
+
+def tactical_changes(tactics_df):
+    '''Function to reduce the player-level extract_tactics table to one row per Substitution or Tactical Shift.'''
+    if tactics_df is None or tactics_df.empty:
+        return pd.DataFrame(columns=["team_name", "minute", "second", "event_type", "formation", "substituted_in", "substituted_out"])
+    changes = tactics_df[tactics_df["event_type"].isin(["Substitution", "Tactical Shift"])]
+    changes = changes[["team_name", "minute", "second", "event_type", "formation", "substituted_in", "substituted_out"]]
+    return changes.drop_duplicates().sort_values(["team_name", "minute", "second"], kind="stable").reset_index(drop=True)
+
+def _explanations(shifts, changes, window_size):
+    '''Function to list, per shift, the team's tactical changes within window_size minutes of the boundary.'''
+    if shifts.empty or changes.empty:
+        return [[] for _ in range(len(shifts))]
+    candidates = shifts[["team_name", "minute"]].reset_index().merge(changes, on="team_name", suffixes=("", "_change"))
+    near = (candidates["minute_change"] >= candidates["minute"] - window_size) & (candidates["minute_change"] < candidates["minute"] + window_size)
+    candidates = candidates[near]
+    explanations = {i: [] for i in shifts.index}
+    for row in candidates.itertuples(index=False):
+        explanation = {"event_type": row.event_type, "minute": int(row.minute_change), "second": int(row.second), "formation": row.formation}
+        if row.event_type == "Substitution":
+            explanation.update({"substituted_in": row.substituted_in, "substituted_out": row.substituted_out})
+        explanations[row.index].append(explanation)
+    return [explanations[i] for i in shifts.index]
+
+def detect_shifts(df, tactics_df=None, window_size=5, step=1, grid_size=8, top_n=3, heat_weight=0.5, min_events=10, pool=2, cube=None):
+    '''Function to find the minutes where each team's shape or build-up changed most.
+
+    Distances between the windows either side of every boundary are scored against the team's own
+    distribution (robust z-score from median and MAD), reduced to local peaks at least window_size
+    minutes apart and the top_n peaks per team are kept. Substitutions and Tactical Shifts from
+    extract_tactics within window_size minutes are attached as candidate explanations.'''
+    cube = cube if cube is not None else TimeCube.from_events(df, grid_size=grid_size)
+    distances = window_distances(cube, window_size, step, heat_weight, min_events, pool)
+    if distances.empty:
+        return pd.DataFrame(columns=SHIFT_COLUMNS + ["rank", "explanations"])
+
+    n_teams = len(cube.teams)
+    scores = distances["distance"].to_numpy().reshape(n_teams, -1)
+    median = np.nanmedian(scores, axis=1, keepdims=True) if np.isfinite(scores).any() else np.zeros((n_teams, 1))
+    mad = 1.4826 * np.nanmedian(np.abs(scores - median), axis=1, keepdims=True) if np.isfinite(scores).any() else np.ones((n_teams, 1))
+    z_scores = (scores - median) / np.where(mad > 0, mad, np.nan)
+    filled = np.nan_to_num(scores, nan=-np.inf)
+    neighbourhood = max(1, (2 * window_size - 1) // step)
+    peaks = np.isfinite(filled) & (filled == maximum_filter1d(filled, size=neighbourhood, axis=1, mode="constant", cval=-np.inf))
+    distances["z_score"] = z_scores.ravel()
+
+    shifts = distances[peaks.ravel()]
+    shifts = shifts.sort_values(["team_name", "distance", "minute"], ascending=[True, False, True], kind="stable")
+    shifts = shifts.groupby("team_name", sort=False).head(top_n)
+    shifts = shifts.assign(rank=shifts.groupby("team_name", sort=False).cumcount() + 1)
+    shifts["explanations"] = _explanations(shifts, tactical_changes(tactics_df), window_size)
+    return shifts[SHIFT_COLUMNS + ["rank", "explanations"]].reset_index(drop=True)
@@ -0,0 +1,237 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from metrics import compute_heatmap_tensor, compute_windowed_metrics_fused
+
+INDEX_FORMAT_VERSION = 1
+WINDOW_COLUMNS = ["match_id", "team_name", "block_index", "start_minute", "end_minute", "n_events", "n_passes"]
+ARRAYS = ["heat", "flux", "signature", "cdf"]
+
+def _normalise_rows(vectors):
+    '''Function to scale every row to unit L2 norm, leaving all-zero rows at zero.'''
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+def _cdf(marginals):
+    '''Function to turn (n, g) marginal counts into cumulative distributions, all-zero rows staying zero.'''
+    totals = marginals.sum(axis=1, keepdims=True)
+    return np.cumsum(np.divide(marginals, totals, out=np.zeros_like(marginals), where=totals > 0), axis=1)
+
+def window_vectors(heat, flux, grid_size, pool=2):
+    '''Function to derive the stored vectors from raw (n, g*g) heatmap and (n, g**4) flux counts.
+
+    Returns normalised heat and flux, a coarse signature (both pooled pool x pool and normalised) for
+    pre-filtering, and the x/y cumulative distributions of heat and of pass starts and ends used for
+    the earth mover's approximation.'''
+    g = grid_size
+    pool = pool if g % pool == 0 else 1
+    c = g // pool
+    heat = np.asarray(heat, dtype=np.float32).reshape(-1, g, g)
+    flux = np.asarray(flux, dtype=np.float32).reshape(-1, g, g, g, g)
+    n = len(heat)
+    pooled_heat = heat.reshape(n, c, pool, c, pool).sum(axis=(2, 4)).reshape(n, -1)
+    pooled_flux = flux.reshape(n, c, pool, c, pool, c, pool, c, pool).sum(axis=(2, 4, 6, 8)).reshape(n, -1)
+    marginals = [heat.sum(axis=2), heat.sum(axis=1),
+                 flux.sum(axis=(2, 3, 4)), flux.sum(axis=(1, 3, 4)), flux.sum(axis=(1, 2, 4)), flux.sum(axis=(1, 2, 3))]
+    return {
+        "heat": _normalise_rows(heat.reshape(n, -1)),
+        "flux": _normalise_rows(flux.reshape(n, -1)),
+        "signature": np.hstack([_normalise_rows(pooled_heat), _normalise_rows(pooled_flux)]),
+        "cdf": np.hstack([_cdf(m) for m in marginals]),
+    }
+
+def match_windows(df, window_size=15, grid_size=8, windowed_metrics=None):
+    '''Function to compute one row per team and window of a match: its window table and raw heat and flux counts.
+
+    Heatmaps cover every located event of the window, flux the passes of compute_windowed_metrics.'''
+    n_cells = grid_size * grid_size
+    blocks = (df["minute"].to_numpy().astype(np.int64) // window_size)
+    heatmaps, entities = compute_heatmap_tensor(df.assign(block_index=blocks), by=["team_name", "block_index"], grid_size=grid_size)
+    if windowed_metrics is None:
+        windowed_metrics = compute_windowed_metrics_fused(df, window_size=window_size, grid_size=grid_size)
+
+    flux = np.zeros((len(entities), n_cells * n_cells), dtype=np.float32)
+    for row, (team_name, block_index) in enumerate(entities):
+        metrics_data = windowed_metrics.get(team_name, {}).get(block_index)
+        if metrics_data is not None:
+            flux[row] = metrics_data["flux"].toarray().ravel()
+    windows = pd.DataFrame({
+        "team_name": entities.get_level_values(0).astype(object),
+        "block_index": entities.get_level_values(1).astype(np.int64),
+    })
+    windows["start_minute"] = windows["block_index"] * window_size
+    windows["end_minute"] = windows["start_minute"] + window_size - 1
+    windows["n_events"] = heatmaps.reshape(len(entities), -1).sum(axis=1).astype(np.int64)
+    windows["n_passes"] = flux.sum(axis=1).astype(np.int64)
+    return windows, heatmaps.reshape(len(entities), -1), flux
+
+class SimilarityIndex:
+    '''Appendable, memory-mapped index of team-window heatmap and pass flux vectors for nearest-neighbour queries.
+
+    Each array lives in its own raw float32 file under path and grows by appending rows, so adding a
+    match never rewrites what is already indexed. meta.json holds the committed row count, which is
+    written last; rows past it (from an interrupted append) are ignored and overwritten.'''
+
+    def __init__(self, path, grid_size=8, window_size=15, pool=2):
+        self.path = Path(path)
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            if self.meta["format_version"] != INDEX_FORMAT_VERSION:
+                raise ValueError(f"{self.path} has unsupported format version {self.meta['format_version']}")
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            dims = {name: array.shape[1] for name, array in window_vectors(np.zeros((1, grid_size * grid_size)),
+                                                                           np.zeros((1, grid_size ** 4)), grid_size, pool).items()}
+            self.meta = {"format_version": INDEX_FORMAT_VERSION, "grid_size": grid_size, "window_size": window_size,
+                         "pool": pool, "n_rows": 0, "dims": dims}
+            self._write_meta()
+        self.grid_size = self.meta["grid_size"]
+        self.window_size = self.meta["window_size"]
+        self._load()
+
+    def _write_meta(self):
+        tmp_path = self.path / "meta.json.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.path / "meta.json")
+
+    def _load(self):
+        '''Function to (re)map the committed rows of every array and read the window table.'''
+        n_rows = self.meta["n_rows"]
+        self._arrays = {
+            name: np.memmap(self.path / f"{name}.f32", dtype=np.float32, mode='r', shape=(n_rows, self.meta["dims"][name]))
+            if n_rows else np.zeros((0, self.meta["dims"][name]), dtype=np.float32)
+            for name in ARRAYS
+        }
+        rows = []
+        windows_path = self.path / "windows.jsonl"
+        if windows_path.exists():
+            with open(windows_path) as f:
+                rows = [json.loads(line) for _, line in zip(range(n_rows), f)]
+        self.windows = pd.DataFrame(rows, columns=WINDOW_COLUMNS)
+        self._row_index = {(m, t, b): i for i, (m, t, b) in enumerate(zip(self.windows["match_id"], self.windows["team_name"], self.windows["block_index"]))}
+        self._centroids = None
+
+    def __len__(self):
+        return self.meta["n_rows"]
+
+    @property
+    def match_ids(self):
+        return sorted(set(self.windows["match_id"].tolist()))
+
+    def add_match(self, match_id, df, windowed_metrics=None):
+        '''Function to append every team-window of a parsed match; a match already in the index is skipped.'''
+        match_id = int(match_id)
+        if match_id in set(self.windows["match_id"].tolist()):
+            return 0
+        windows, heat, flux = match_windows(df, self.window_size, self.grid_size, windowed_metrics)
+        if windows.empty:
+            return 0
+        vectors = window_vectors(heat, flux, self.grid_size, self.meta["pool"])
+        n_rows = self.meta["n_rows"]
+        for name in ARRAYS:
+            with open(self.path / f"{name}.f32", 'r+b' if (self.path / f"{name}.f32").exists() else 'wb') as f:
+                f.seek(n_rows * self.meta["dims"][name] * 4)
+                f.write(np.ascontiguousarray(vectors[name], dtype=np.float32).tobytes())
+                f.truncate()
+        windows.insert(0, "match_id", match_id)
+        self._truncate_windows(n_rows)
+        with open(self.path / "windows.jsonl", 'a') as f:
+            for row in windows[WINDOW_COLUMNS].itertuples(index=False):
+                f.write(json.dumps({c: (v.item() if isinstance(v, np.generic) else v) for c, v in zip(WINDOW_COLUMNS, row)}) + "\n")
+        self.meta["n_rows"] = n_rows + len(windows)
+        self._write_meta()
+        self._load()
+        return len(windows)
+
+    def _truncate_windows(self, n_rows):
+        '''Function to drop window lines left behind by an interrupted append.'''
+        windows_path = self.path / "windows.jsonl"
+        if not windows_path.exists():
+            return
+        with open(windows_path) as f:
+            lines = f.readlines()
+        if len(lines) != n_rows:
+            with open(windows_path, 'w') as f:
+                f.writelines(lines[:n_rows])
+
+    def row(self, match_id, team_name, block_index):
+        '''Function to return the index row of one team-window.'''
+        return self._row_index[(int(match_id), team_name, int(block_index))]
+
+    def _scores(self, query, rows, metric, heat_weight):
+        '''Function to score rows (all rows when None, without copying the mapped arrays) against a query; higher is more similar.'''
+        select = (lambda name: self._arrays[name]) if rows is None else (lambda name: self._arrays[name][rows])
+        if metric == "cosine":
+            return heat_weight * (select("heat") @ query["heat"]) + (1 - heat_weight) * (select("flux") @ query["flux"])
+        if metric == "emd":
+            g = self.grid_size
+            distances = np.abs(select("cdf") - query["cdf"]).reshape(-1, 6, g).sum(axis=2) / g
+            return -(heat_weight * distances[:, :2].mean(axis=1) + (1 - heat_weight) * distances[:, 2:].mean(axis=1))
+        raise ValueError(f"Unknown metric {metric!r}, expected 'cosine' or 'emd'")
+
+    def query_vectors(self, query, k=10, metric="cosine", heat_weight=0.5, candidates=None, exclude_match=None):
+        '''Function to return the k team-windows most similar to query, a dict of window_vectors rows.
+
+        candidates, when set, first keeps that many rows by cosine similarity of the pooled signatures
+        and only scores those exactly. Rows of exclude_match are left out. Returns the window table rows
+        with a score column (cosine similarity, or negated approximate earth mover's distance).'''
+        allowed = np.ones(len(self), dtype=bool)
+        if exclude_match is not None:
+            allowed &= self.windows["match_id"].to_numpy() != int(exclude_match)
+        n_allowed = int(allowed.sum())
+        rows = None
+        if candidates is not None and candidates < n_allowed:
+            coarse = self._arrays["signature"] @ query["signature"]
+            coarse[~allowed] = -np.inf
+            rows = np.sort(np.argpartition(-coarse, candidates - 1)[:candidates])
+            n_allowed = candidates
+        k = min(k, n_allowed)
+        if k <= 0:
+            return self.windows.iloc[:0].assign(score=pd.Series(dtype=np.float32))
+
+        scores = self._scores(query, rows, metric, heat_weight)
+        if rows is None:
+            rows = np.arange(len(self))
+            scores[~allowed] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((rows[top], -scores[top]))]
+        return self.windows.iloc[rows[top]].assign(score=scores[top])
+
+    def query(self, match_id, team_name, block_index, k=10, metric="cosine", heat_weight=0.5, candidates=None, same_match=False):
+        '''Function to find the team-windows that looked most like an indexed one, from other matches unless same_match.'''
+        row = self.row(match_id, team_name, block_index)
+        query = {name: np.asarray(array[row]) for name, array in self._arrays.items()}
+        result = self.query_vectors(query, k + 1 if same_match else k, metric, heat_weight, candidates,
+                                    exclude_match=None if same_match else match_id)
+        return result[result.index != row].head(k)
+
+    def _match_centroids(self):
+        '''Function to average the normalised vectors of every (match, team) into one row per team-match.'''
+        if self._centroids is None:
+            keys = self.windows[["match_id", "team_name"]]
+            starts = np.flatnonzero(~keys.duplicated().to_numpy())
+            sizes = np.diff(np.append(starts, len(keys)))[:, None]
+            self._centroids = (
+                keys.iloc[starts].reset_index(drop=True),
+                {name: _normalise_rows(np.add.reduceat(np.asarray(self._arrays[name]), starts, axis=0) / sizes)
+                 for name in ("heat", "flux")},
+            )
+        return self._centroids
+
+    def query_match(self, match_id, team_name, k=10, heat_weight=0.5):
+        '''Function to find the team-matches most like a team's whole match, by cosine of averaged window vectors.'''
+        keys, centroids = self._match_centroids()
+        match = np.flatnonzero((keys["match_id"] == int(match_id)).to_numpy() & (keys["team_name"] == team_name).to_numpy())[0]
+        scores = heat_weight * (centroids["heat"] @ centroids["heat"][match]) + (1 - heat_weight) * (centroids["flux"] @ centroids["flux"][match])
+        scores[(keys["match_id"] == int(match_id)).to_numpy()] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return keys.iloc[:0].assign(score=pd.Series(dtype=np.float32))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return keys.iloc[top].assign(score=scores[top])
@@ -0,0 +1,230 @@
+import json
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from pathlib import Path
+from scipy.sparse import csr_matrix
+from metrics import _zone_usage_frame, _zone_counts_table, CHANNEL_LABELS, THIRD_LABELS, SCHEMA_CHANNEL_LABELS
+from utils import save_match_metrics
+
+MAGIC = b"THMSTORE"
+STORE_FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+def _counts(table, labels):
+    '''Function to read a channel or third usage table back into a count vector ordered like labels.'''
+    counts = np.zeros(len(labels), dtype=np.int32)
+    if isinstance(table, pd.DataFrame):
+        table = table.iloc[:, 0] if table.shape[1] else pd.Series(dtype=np.int64)
+    if isinstance(table, pd.Series):
+        positions = {label: i for i, label in enumerate(labels)}
+        for label, count in table.items():
+            counts[positions[label]] = count
+    return counts
+
+def _zone_vector(zone_table):
+    '''Function to read a zone_counts table into a 9-vector ordered channel * 3 + third.'''
+    counts = np.zeros(9, dtype=np.int32)
+    if isinstance(zone_table, pd.DataFrame) and not zone_table.empty:
+        channels = {label: i for i, label in enumerate(SCHEMA_CHANNEL_LABELS)}
+        thirds = {label: i for i, label in enumerate(THIRD_LABELS)}
+        for channel, third, count in zip(zone_table["vertical_channel"], zone_table["horizontal_third"], zone_table["count"]):
+            counts[channels[channel] * 3 + thirds[third]] = count
+    return counts
+
+def write_metrics_store(path, matches):
+    '''Function to write the metrics of one or many matches into a single memory-mappable file.
+
+    matches is a list of dicts with match_id, team_infor (team name -> id), windowed_metrics and
+    optionally heatmaps (team name -> grid). All flux matrices go into one set of concatenated CSR
+    arrays with per-window offsets, next to the window table, zone counts and heatmaps.'''
+    teams = {}
+    window_rows = []
+    data, indices, indptrs = [], [], []
+    heatmap_rows, heatmaps = [], []
+    grid_size = None
+
+    for match in matches:
+        match_id = int(match["match_id"])
+        for team_name, team_id in match["team_infor"].items():
+            teams.setdefault(team_name, int(team_id))
+        for team_name, blocks in match["windowed_metrics"].items():
+            teams.setdefault(team_name, match["team_infor"].get(team_name))
+            for block_index, metrics_data in blocks.items():
+                flux = csr_matrix(metrics_data["flux"])
+                flux.sum_duplicates()
+                n_cells = flux.shape[0]
+                grid_size = grid_size or int(round(n_cells ** 0.5))
+                window_rows.append((match_id, team_name, int(block_index), int(metrics_data["window"][0]), int(metrics_data["window"][1]),
+                                    _counts(metrics_data.get("channel"), CHANNEL_LABELS),
+                                    _counts(metrics_data.get("third"), THIRD_LABELS),
+                                    _zone_vector(metrics_data.get("zone"))))
+                data.append(flux.data.astype(np.int32))
+                indices.append(flux.indices.astype(np.int32))
+                indptrs.append(flux.indptr.astype(np.int32))
+        for team_name, heat in (match.get("heatmaps") or {}).items():
+            teams.setdefault(team_name, match["team_infor"].get(team_name))
+            heatmap_rows.append((match_id, team_name))
+            heatmaps.append(np.asarray(heat, dtype=np.float64))
+
+    team_names = list(teams)
+    team_codes = {name: i for i, name in enumerate(team_names)}
+    grid_size = grid_size or (heatmaps[0].shape[0] if heatmaps else 0)
+    n_cells = grid_size * grid_size
+    lengths = np.array([len(d) for d in data], dtype=np.int64)
+    arrays = {
+        "window_match": np.array([r[0] for r in window_rows], dtype=np.int64),
+        "window_team": np.array([team_codes[r[1]] for r in window_rows], dtype=np.int32),
+        "window_block": np.array([r[2] for r in window_rows], dtype=np.int32),
+        "window_start": np.array([r[3] for r in window_rows], dtype=np.int32),
+        "window_end": np.array([r[4] for r in window_rows], dtype=np.int32),
+        "channel": np.array([r[5] for r in window_rows], dtype=np.int32).reshape(-1, 3),
+        "third": np.array([r[6] for r in window_rows], dtype=np.int32).reshape(-1, 3),
+        "zone": np.array([r[7] for r in window_rows], dtype=np.int32).reshape(-1, 9),
+        "flux_offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        "flux_indptr": np.array(indptrs, dtype=np.int32).reshape(-1, n_cells + 1),
+        "flux_indices": np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+        "flux_data": np.concatenate(data) if data else np.zeros(0, dtype=np.int32),
+        "heatmap_match": np.array([r[0] for r in heatmap_rows], dtype=np.int64),
+        "heatmap_team": np.array([team_codes[r[1]] for r in heatmap_rows], dtype=np.int32),
+        "heatmaps": np.array(heatmaps, dtype=np.float64) if heatmaps else np.zeros((0, grid_size, grid_size)),
+    }
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({
+        "format_version": STORE_FORMAT_VERSION,
+        "grid_size": grid_size,
+        "teams": [{"team_id": teams[name], "team_name": name} for name in team_names],
+        "arrays": layout,
+    }, separators=(",", ":")).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    tmp_path.replace(path)
+    return path
+
+def save_match_store(windowed_metrics, match_id, team_infor, output_dir, heatmaps=None):
+    '''Function to write one match's metrics to output_dir/metrics/<match_id>.thm.'''
+    path = Path(output_dir) / "metrics" / f"{match_id}.thm"
+    return write_metrics_store(path, [{"match_id": match_id, "team_infor": team_infor, "windowed_metrics": windowed_metrics, "heatmaps": heatmaps}])
+
+class MetricsStore:
+    '''Read-only, memory-mapped view of a file written by write_metrics_store.
+
+    Flux matrices, zone counts and heatmaps are returned lazily as views into the mapped file,
+    so opening a store and reading one window touches only that window's bytes.'''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._buffer = np.memmap(self.path, dtype=np.uint8, mode='r')
+        if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{self.path} is not a metrics store")
+        header_length = int(self._buffer[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+        header = json.loads(bytes(self._buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_length]))
+        if header["format_version"] != STORE_FORMAT_VERSION:
+            raise ValueError(f"{self.path} has unsupported format version {header['format_version']}")
+        data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        self.grid_size = header["grid_size"]
+        self.teams = header["teams"]
+        self.team_names = [team["team_name"] for team in self.teams]
+        self._arrays = {}
+        for name, info in header["arrays"].items():
+            dtype = np.dtype(info["dtype"])
+            start = data_start + info["offset"]
+            count = int(np.prod(info["shape"]))
+            self._arrays[name] = self._buffer[start:start + count * dtype.itemsize].view(dtype).reshape(info["shape"])
+
+        self._window_index = {
+            (int(m), self.team_names[t], int(b)): i
+            for i, (m, t, b) in enumerate(zip(self._arrays["window_match"], self._arrays["window_team"], self._arrays["window_block"]))
+        }
+        self._heatmap_index = {
+            (int(m), self.team_names[t]): i for i, (m, t) in enumerate(zip(self._arrays["heatmap_match"], self._arrays["heatmap_team"]))
+        }
+
+    @property
+    def match_ids(self):
+        return sorted(set(self._arrays["window_match"].tolist()) | set(self._arrays["heatmap_match"].tolist()))
+
+    def windows(self, match_id=None):
+        '''Function to return the window table (one row per match, team and window).'''
+        table = pd.DataFrame({
+            "match_id": self._arrays["window_match"],
+            "team_name": np.array(self.team_names, dtype=object)[self._arrays["window_team"]] if self.team_names else [],
+            "block_index": self._arrays["window_block"],
+            "start_minute": self._arrays["window_start"],
+            "end_minute": self._arrays["window_end"],
+        })
+        return table if match_id is None else table[table["match_id"] == match_id]
+
+    def _row(self, match_id, team_name, block_index):
+        return self._window_index[(int(match_id), team_name, int(block_index))]
+
+    def flux(self, match_id, team_name, block_index):
+        '''Function to return one window's flux matrix as a CSR matrix backed by the mapped file.'''
+        row = self._row(match_id, team_name, block_index)
+        lo, hi = self._arrays["flux_offsets"][row], self._arrays["flux_offsets"][row + 1]
+        n_cells = self.grid_size * self.grid_size
+        return csr_matrix((self._arrays["flux_data"][lo:hi], self._arrays["flux_indices"][lo:hi], self._arrays["flux_indptr"][row]),
+                          shape=(n_cells, n_cells), copy=False)
+
+    def stacked_flux(self, match_id=None):
+        '''Function to return (windows, flux) like stack_flux_windows for one match or the whole store.
+
+        All windows' matrices already share the concatenated data and index arrays, so the stacked
+        matrix only needs new column indices (from_cell * n_cells + to_cell).'''
+        windows = self.windows(match_id)
+        n_cells = self.grid_size * self.grid_size
+        indptr = self._arrays["flux_indptr"]
+        lengths = np.diff(indptr, axis=1).ravel()
+        from_cells = np.repeat(np.tile(np.arange(n_cells), len(indptr)), lengths)
+        columns = from_cells * n_cells + self._arrays["flux_indices"]
+        flux = csr_matrix((self._arrays["flux_data"], columns, self._arrays["flux_offsets"]), shape=(len(indptr), n_cells * n_cells))
+        if match_id is not None:
+            flux = flux[windows.index.to_numpy()]
+        return windows.reset_index(drop=True), flux
+
+    def zone_counts(self, match_id, team_name, block_index):
+        '''Function to return one window's channel (3), third (3) and zone (9) count vectors.'''
+        row = self._row(match_id, team_name, block_index)
+        return self._arrays["channel"][row], self._arrays["third"][row], self._arrays["zone"][row]
+
+    def heatmap(self, match_id, team_name):
+        '''Function to return a stored team heatmap as a view into the mapped file.'''
+        return self._arrays["heatmaps"][self._heatmap_index[(int(match_id), team_name)]]
+
+    def windowed_metrics(self, match_id):
+        '''Function to rebuild the compute_windowed_metrics structure of one match from the store.'''
+        windowed_pass_fluxes = defaultdict(dict)
+        for row in self.windows(match_id).itertuples(index=False):
+            channel, third, zone = self.zone_counts(match_id, row.team_name, row.block_index)
+            windowed_pass_fluxes[row.team_name][row.block_index] = {
+                "flux": self.flux(match_id, row.team_name, row.block_index),
+                "channel": _zone_usage_frame(channel[:, None], CHANNEL_LABELS, [row.team_name], "channel"),
+                "third": _zone_usage_frame(third[:, None], THIRD_LABELS, [row.team_name], "third"),
+                "zone": _zone_counts_table(zone, [row.team_name]),
+                "window": (row.start_minute, row.end_minute),
+            }
+        return windowed_pass_fluxes
+
+    def export_json(self, match_id, output_dir):
+        '''Function to export one match to the per-window .npz files and JSON index written by save_match_metrics.'''
+        windowed_metrics = self.windowed_metrics(match_id)
+        heatmap_teams = {team for (m, team) in self._heatmap_index if m == int(match_id)}
+        team_infor = {team["team_name"]: team["team_id"] for team in self.teams if team["team_name"] in set(windowed_metrics) | heatmap_teams}
+        save_match_metrics(windowed_metrics, match_id, team_infor, output_dir)
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from scipy.sparse import csr_matrix
+from metrics import _factorize_keys, _flux_cells, _heatmap_cells, classify_zones, SCHEMA_CHANNEL_LABELS, THIRD_LABELS
+
+def _cumulative_counts(team_codes, minutes, cells, n_teams, n_minutes, n_cells):
+    '''Function to count (team, minute, cell) triples and take the running sum over minutes.
+
+    Returns an array of shape (n_teams, n_minutes + 1, n_cells) whose [:, m] slice holds the counts before minute m.'''
+    keys = (team_codes.astype(np.int64) * n_minutes + minutes) * n_cells + cells
+    counts = np.bincount(keys, minlength=n_teams * n_minutes * n_cells).reshape(n_teams, n_minutes, n_cells)
+    cumulative = np.zeros((n_teams, n_minutes + 1, n_cells), dtype=np.int32)
+    np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+    return cumulative
+
+class TimeCube:
+    '''Prefix sums of heatmap, zone and pass flux counts per team and minute for one match.
+
+    Any [start_minute, end_minute] range (both inclusive) is answered by subtracting two
+    cumulative slices, so the cost does not depend on the number of events.'''
+
+    def __init__(self, teams, grid_size, heat_cum, zone_cum, flux_cum):
+        self.teams = list(teams)
+        self.grid_size = grid_size
+        self.heat_cum = heat_cum
+        self.zone_cum = zone_cum
+        self.flux_cum = flux_cum
+        self._team_index = {team: i for i, team in enumerate(self.teams)}
+
+    @classmethod
+    def from_events(cls, df, grid_size=8, by="team_name", event_type=None):
+        '''Function to build the cube from a parsed match frame.
+
+        Heatmap and zone counts cover events of event_type (all events when None) with a location;
+        flux counts cover passes with start and end locations, binned like compute_windowed_metrics.'''
+        team_codes, teams = _factorize_keys(df[by])
+        minutes = df["minute"].to_numpy()
+        n_teams = len(teams)
+        n_minutes = int(minutes.max()) + 1 if len(minutes) else 0
+        n_cells = grid_size * grid_size
+
+        located = (team_codes >= 0) & df["location_x"].notna().to_numpy() & df["location_y"].notna().to_numpy()
+        if event_type is not None:
+            located &= (df["type.name"] == event_type).to_numpy()
+        cells, inside = _heatmap_cells(df["location_x"], df["location_y"], grid_size)
+        heat = located & inside
+        heat_cum = _cumulative_counts(team_codes[heat], minutes[heat], cells[heat], n_teams, n_minutes, n_cells)
+
+        zones = classify_zones(df)["zone"].to_numpy()
+        zone_cum = _cumulative_counts(team_codes[located], minutes[located], zones[located], n_teams, n_minutes, 9)
+
+        passes = (team_codes >= 0) & (df["type.name"] == "Pass").to_numpy()
+        passes &= df[["location_x", "location_y", "pass_end_location_x", "pass_end_location_y"]].notna().all(axis=1).to_numpy()
+        starts_flat, ends_flat, inside = _flux_cells(df[passes], grid_size)
+        lanes = starts_flat[inside] * n_cells + ends_flat[inside]
+        flux_cum = _cumulative_counts(team_codes[passes][inside], minutes[passes][inside], lanes, n_teams, n_minutes, n_cells * n_cells)
+
+        return cls(teams, grid_size, heat_cum, zone_cum, flux_cum)
+
+    @property
+    def n_minutes(self):
+        return self.heat_cum.shape[1] - 1
+
+    def _range(self, cumulative, team, start_minute, end_minute):
+        '''Function to subtract the cumulative slices bounding [start_minute, end_minute] for one team.'''
+        start = min(max(int(start_minute), 0), self.n_minutes)
+        end = min(max(int(end_minute) + 1, start), self.n_minutes)
+        team_cum = cumulative[self._team_index[team]]
+        return team_cum[end] - team_cum[start]
+
+    def heatmap(self, team, start_minute=0, end_minute=None):
+        '''Function to return the grid_size x grid_size heatmap of a team over a minute range.'''
+        end_minute = self.n_minutes if end_minute is None else end_minute
+        heat = self._range(self.heat_cum, team, start_minute, end_minute)
+        return heat.reshape(self.grid_size, self.grid_size).astype(float)
+
+    def heatmaps(self, start_minute=0, end_minute=None):
+        '''Function to return heatmaps of every team over a minute range, keyed like compute_heatmap.'''
+        return {team: self.heatmap(team, start_minute, end_minute) for team in self.teams}
+
+    def zone_counts(self, team, start_minute=0, end_minute=None):
+        '''Function to return the 3x3 channel-by-third counts of a team over a minute range, labelled like the zone_usage schema.'''
+        end_minute = self.n_minutes if end_minute is None else end_minute
+        zones = self._range(self.zone_cum, team, start_minute, end_minute).reshape(3, 3)
+        return pd.DataFrame(zones.astype(np.int64), index=pd.Index(SCHEMA_CHANNEL_LABELS, name="channel"), columns=pd.Index(THIRD_LABELS, name="third"))
+
+    def flux(self, team, start_minute=0, end_minute=None):
+        '''Function to return the pass flux matrix of a team over a minute range as a CSR matrix.'''
+        end_minute = self.n_minutes if end_minute is None else end_minute
+        n_cells = self.grid_size * self.grid_size
+        lanes = self._range(self.flux_cum, team, start_minute, end_minute)
+        return csr_matrix(lanes.reshape(n_cells, n_cells).astype(np.int64))
+
+    def windowed_fluxes(self, window_size=15):
+        '''Function to slice the cube into fixed windows, keyed like compute_windowed_metrics.'''
+        windowed_pass_fluxes = defaultdict(dict)
+        for team in self.teams:
+            for block_index in range(-(-self.n_minutes // window_size)):
+                start_minute = block_index * window_size
+                end_minute = start_minute + window_size - 1
+                flux = self.flux(team, start_minute, end_minute)
+                if flux.nnz:
+                    windowed_pass_fluxes[team][block_index] = {"flux": flux, "window": (start_minute, end_minute)}
+        return windowed_pass_fluxes
@@ -1,9 +1,10 @@
 import numpy as np
-from scipy.sparse import coo_matrix, save_npz
+from scipy.sparse import coo_matrix, csr_matrix, save_npz, vstack
 from pathlib import Path
 import pandas as pd
 import json
 from datetime import datetime
+from instrument import stage
 
 def _calculate_flux_matrix(df_pass, grid_size=8):
     xbins = np.linspace(0, 100, grid_size+1)
@@ -29,29 +30,7 @@ def _calculate_flux_matrix(df_pass, grid_size=8):
 
     return flux_csr
 
-def _calculate_flux_matrix(df_pass, grid_size=8):
-    xbins = np.linspace(0, 100, grid_size+1)
-    ybins = np.linspace(0, 100, grid_size+1)
-
-    startsx = np.digitize(df_pass["location_x"], xbins) - 1
-    startsy = np.digitize(df_pass["location_y"], ybins) - 1
-    endsx = np.digitize(df_pass["pass_end_location_x"], xbins) - 1
-    endsy = np.digitize(df_pass["pass_end_location_y"], ybins) - 1
-
-    starts_flat = startsx * grid_size + startsy
-    ends_flat = endsx * grid_size + endsy
-
-    max_index = grid_size * grid_size
-    mask = (starts_flat >= 0) & (starts_flat < max_index) & (ends_flat >= 0) & (ends_flat < max_index)
-
-    starts_filtered = starts_flat[mask]
-    ends_filtered = ends_flat[mask]
-
-    data = np.ones(len(starts_filtered), dtype=int)
-    flux_coo = coo_matrix((data, (starts_filtered, ends_filtered)), shape=(max_index, max_index))
-    flux_csr = flux_coo.tocsr()
-
-    return flux_csr
+@stage()
 def save_match_metrics(windowed_metrics, match_id, team_infor, output_dir):
     base_path = Path(output_dir)
     metrics_path = base_path / "metrics"
@@ -94,82 +73,11 @@ def save_match_metrics(windowed_metrics, match_id, team_infor, output_dir):
             else:
                 third_counts = []
 
-            flux_metric_obj = {
-                "metric_type": "pass_flux_window_matrix", 
-                "team_id": team_id, 
-                "time_window": {"start_minute": start_min, 
-                                "end_minute": end_min},
-                "grid_size": flux_matrix.shape[0] ** 0.5, 
-                "flux_matrix_path": str(flux_filepath.relative_to(base_path)), 
-                "cell_indexing": "row_major: (row*grid_size + col)"
-            }
-
-            zone_usage_obj = {
-                    "metric_type": "zone_usage",
-                    "team_id": team_id,
-                    "event_type": "Pass", 
-                    "time_window": {"start_minute": start_min, "end_minute": end_min},
-                    "channel_counts": channel_counts,
-                    "third_counts": third_counts
-                }
-                
-            all_metrics_list.append(flux_metric_obj)
-            all_metrics_list.append(zone_usage_obj)
-    
-    final_output = {
-        "match_id": match_id, 
-        'teams': [{'team_id': v, 'team_name': k} for k, v in team_infor.items()], 
-        'metrics_generated_at': datetime.now().isoformat(), 
-        'metrics': all_metrics_list
-    }
-
-    json_filepath = metrics_path / f"{match_id}_metrics.json"
-    with open(json_filepath, 'w') as f:
-        json.dump(final_output, f, indent=2)
-
-    print(f'Successfully saved metrics to {json_filepath}')
-
-def save_match_metrics(windowed_metrics, match_id, team_infor, output_dir):
-    base_path = Path(output_dir)
-    metrics_path = base_path / "metrics"
-    flux_path = metrics_path / "flux_matrices"
-    flux_path.mkdir(parents=True, exist_ok=True)
-
-    all_metrics_list = []
-
-    for team_name, blocks in windowed_metrics.items():
-        team_id = team_infor.get(team_name)
-        for block_index, metrics_data in blocks.items():
-            window = metrics_data['window']
-            start_min, end_min = int(window[0]), int(window[1])
-            flux_matrix = metrics_data.get('flux')
-            if flux_matrix is not None and flux_matrix.nnz > 0:
-                flux_filename = f"{match_id}_{team_id}_{start_min}-{end_min}_flux.npz"
-                flux_filepath = flux_path / flux_filename
-
-                save_npz(flux_filepath, flux_matrix)
-            
-            channel_series = metrics_data.get('channel')
-            if isinstance(channel_series, pd.Series):
-                channel_counts = channel_series.reset_index().rename(columns={channel_series.name: 'count'}).to_dict('records')
-
-            elif isinstance(channel_series, pd.DataFrame):
-                count_channel_name = [col for col in channel_series.columns if col != 'channel'][0]
-                channel_counts = channel_series.reset_index().rename(columns={count_channel_name: 'count'}).to_dict('records')
-
-            else:
-                channel_counts = []
-                
-            third_series = metrics_data.get('third')
-            if isinstance(third_series, pd.Series):
-                third_counts = third_series.reset_index().rename(columns={third_series.name: 'count'}).to_dict('records')
-
-            elif isinstance(third_series, pd.DataFrame):
-                count_third_name = [col for col in third_series.columns if col != 'third'][0]
-                third_counts = third_series.reset_index().rename(columns={count_third_name: 'count'}).to_dict('records')
-
+            zone_table = metrics_data.get('zone')
+            if isinstance(zone_table, pd.DataFrame):
+                zone_counts = zone_table[['vertical_channel', 'horizontal_third', 'count']].to_dict('records')
             else:
-                third_counts = []
+                zone_counts = []
 
             flux_metric_obj = {
                 "metric_type": "pass_flux_window_matrix", 
@@ -187,7 +95,8 @@ def save_match_metrics(windowed_metrics, match_id, team_infor, output_dir):
                     "event_type": "Pass", 
                     "time_window": {"start_minute": start_min, "end_minute": end_min},
                     "channel_counts": channel_counts,
-                    "third_counts": third_counts
+                    "third_counts": third_counts,
+                    "zone_counts": zone_counts
                 }
                 
             all_metrics_list.append(flux_metric_obj)
@@ -206,15 +115,14 @@ def save_match_metrics(windowed_metrics, match_id, team_infor, output_dir):
 
     print(f'Successfully saved metrics to {json_filepath}')
 
-    
-            
+@stage()
 def summarize_flux_matrix(flux_csr_matrix, top_n_lanes=3):
     if flux_csr_matrix is None or flux_csr_matrix.nnz == 0:
         return {"total_passes": 0, "top_lanes": []}
     
     flux_coo_matrix = flux_csr_matrix.tocoo()
     
-    total_passes = int(flux_coo_matrix.nnz)
+    total_passes = int(flux_coo_matrix.data.sum())
     pass_lanes = sorted(zip(flux_coo_matrix.data, flux_coo_matrix.row, flux_coo_matrix.col), 
                         key=lambda x: x[0], reverse=True)
     top_lanes = []
@@ -225,7 +133,70 @@ def summarize_flux_matrix(flux_csr_matrix, top_n_lanes=3):
             "count": int(count)
         })
 
-        return {
-            "total_passes": total_passes, 
-            'top_lanes': top_lanes
-        }
\ No newline at end of file
+    return {
+        "total_passes": total_passes, 
+        'top_lanes': top_lanes
+    }
+
+def stack_flux_windows(windowed_metrics, match_id=None):
+    '''Function to stack every window's flux matrix into one CSR matrix with one flattened window per row.
+
+    Returns (windows, flux): windows has match_id, team_name, block_index, start_minute and end_minute
+    per row of flux, and lane from_cell -> to_cell sits in column from_cell * n_cells + to_cell.'''
+    rows, matrices = [], []
+    for team_name, blocks in windowed_metrics.items():
+        for block_index, metrics_data in blocks.items():
+            window = metrics_data["window"]
+            rows.append((match_id, team_name, int(block_index), int(window[0]), int(window[1])))
+            matrices.append(csr_matrix(metrics_data["flux"]).reshape(1, -1))
+    windows = pd.DataFrame(rows, columns=["match_id", "team_name", "block_index", "start_minute", "end_minute"])
+    flux = vstack(matrices, format="csr") if matrices else csr_matrix((0, 0), dtype=np.int64)
+    return windows, flux
+
+@stage()
+def summarize_flux_windows(windows, flux, top_n_lanes=3):
+    '''Function to summarise many stacked flux windows at once: total passes and the top_n_lanes busiest lanes of each.
+
+    windows and flux are as returned by stack_flux_windows (or MetricsStore.stacked_flux), for one
+    match or a whole season. Lanes are picked with np.argpartition over a padded (windows x lanes)
+    array; ties go to the lower cell index, as in summarize_flux_matrix. Returns one row per window
+    and lane, with rank 1 for the busiest; windows without passes keep one row with empty lane columns.'''
+    flux = csr_matrix(flux)
+    flux.sum_duplicates()
+    flux.eliminate_zeros()
+    n_windows, n_lanes = flux.shape
+    n_cells = int(round(n_lanes ** 0.5))
+    lengths = np.diff(flux.indptr)
+    totals = np.bincount(np.repeat(np.arange(n_windows), lengths), weights=flux.data, minlength=n_windows).astype(np.int64)
+
+    width = int(lengths.max()) if n_windows else 0
+    top_n = min(top_n_lanes, width)
+    if top_n:
+        # one sortable key per lane: higher count first, then lower lane index
+        keys = np.full((n_windows, width), -1, dtype=np.int64)
+        positions = np.arange(flux.nnz) - np.repeat(flux.indptr[:-1], lengths)
+        keys[np.repeat(np.arange(n_windows), lengths), positions] = flux.data.astype(np.int64) * n_lanes + (n_lanes - 1 - flux.indices)
+        top = np.argpartition(-keys, top_n - 1, axis=1)[:, :top_n] if top_n < width else np.arange(width)[None, :].repeat(n_windows, axis=0)
+        top_keys = np.take_along_axis(keys, top, axis=1)
+        top_keys = -np.sort(-top_keys, axis=1)[:, :top_n]
+    else:
+        top_keys = np.full((n_windows, 0), -1, dtype=np.int64)
+
+    window_rows, ranks = np.nonzero(top_keys >= 0)
+    counts, lanes = np.divmod(top_keys[window_rows, ranks], n_lanes)
+    from_cells, to_cells = np.divmod(n_lanes - 1 - lanes, n_cells)
+    lanes_df = pd.DataFrame({
+        "_window": window_rows,
+        "rank": ranks + 1,
+        "from_cell": from_cells,
+        "to_cell": to_cells,
+        "count": counts,
+    })
+    empty = np.setdiff1d(np.arange(n_windows), window_rows)
+    lanes_df = pd.concat([lanes_df, pd.DataFrame({"_window": empty})], ignore_index=True)
+    lanes_df = lanes_df.astype({c: "Int64" for c in ["rank", "from_cell", "to_cell", "count"]})
+    lanes_df = lanes_df.sort_values(["_window", "rank"], kind="stable", na_position="first").reset_index(drop=True)
+
+    summary = windows.reset_index(drop=True).iloc[lanes_df["_window"].to_numpy()].reset_index(drop=True)
+    summary["total_passes"] = totals[lanes_df["_window"].to_numpy()]
+    return pd.concat([summary, lanes_df.drop(columns="_window")], axis=1)